@@ -0,0 +1,278 @@
+# Assign reviewers to papers with min-cost flow.
+#
+# Each paper needs a number of reviews and each reviewer takes at most a
+# maximum number of papers. A reviewer may get a paper unless they are in
+# conflict with it (or gave it a preference of PREF_CONFLICT or less), and the
+# value of a (paper, reviewer) pair is
+#
+#   pref_weight * preference + topic_weight * number of shared topics
+#
+# Only the max_candidates most valuable reviewers of each paper are kept as
+# edges, which keeps the graph sparse. The assignment with the largest total
+# value that fills as many reviews as possible is then found with min-cost
+# flow (source -> paper -> reviewer -> sink). If the pruned graph cannot fill
+# every review, the flow is run again over all reviewers.
+
+import heapq
+import unicodecsv as csv
+import numpy as np
+
+# HotCRP treats preferences of -100 or less as conflicts.
+PREF_CONFLICT = -100
+
+INFINITY = float("inf")
+
+class FlowGraph(object):
+  """ A residual graph for min-cost flow with integer costs.
+
+  Edges are stored in flat lists; edge e ^ 1 is the reverse of edge e.
+  """
+
+  def __init__(self, num_nodes):
+    self.adj = [[] for i in range(num_nodes)]
+    self.to = []
+    self.cap = []
+    self.cost = []
+
+  def add_edge(self, u, v, cap, cost):
+    """ Add an edge from u to v and return its index. """
+    e = len(self.to)
+    self.to += [v, u]
+    self.cap += [cap, 0]
+    self.cost += [cost, -cost]
+    self.adj[u].append(e)
+    self.adj[v].append(e + 1)
+    return e
+
+  def shortest_paths(self, source, sink, potential):
+    """ Dijkstra on reduced costs, stopped once the sink is settled.
+
+    Returns the distances, clamped to the sink's distance (or None if the
+    sink cannot be reached). Clamping keeps the reduced costs of all residual
+    edges non-negative after the potentials are updated.
+    """
+    to, cap, cost, adj = self.to, self.cap, self.cost, self.adj
+    dist = [INFINITY] * len(adj)
+    dist[source] = 0
+    done = [False] * len(adj)
+    heap = [(0, source)]
+    while heap:
+      d, u = heapq.heappop(heap)
+      if done[u]:
+        continue
+      done[u] = True
+      if u == sink:
+        break
+      pu = potential[u]
+      for e in adj[u]:
+        if cap[e] > 0:
+          v = to[e]
+          nd = d + cost[e] + pu - potential[v]
+          if nd < dist[v]:
+            dist[v] = nd
+            heapq.heappush(heap, (nd, v))
+    if not done[sink]:
+      return None
+    limit = dist[sink]
+    return [min(d, limit) for d in dist]
+
+  def augment(self, source, sink, potential):
+    """ Push a blocking flow along edges of zero reduced cost (Dinic).
+
+    Returns the amount of flow pushed.
+    """
+    to, cap, cost, adj = self.to, self.cap, self.cost, self.adj
+    admissible = lambda u, e: (cap[e] > 0 and
+                               cost[e] + potential[u] - potential[to[e]] == 0)
+    total = 0
+    while True:
+      # Level the admissible graph breadth first.
+      level = [-1] * len(adj)
+      level[source] = 0
+      queue = [source]
+      for u in queue:
+        for e in adj[u]:
+          if level[to[e]] < 0 and admissible(u, e):
+            level[to[e]] = level[u] + 1
+            queue.append(to[e])
+      if level[sink] < 0:
+        return total
+
+      # Find augmenting paths depth first, without revisiting dead ends.
+      pos = [0] * len(adj)
+      while True:
+        path = []
+        u = source
+        while u != sink:
+          edges = adj[u]
+          while pos[u] < len(edges):
+            e = edges[pos[u]]
+            if level[to[e]] == level[u] + 1 and admissible(u, e):
+              break
+            pos[u] += 1
+          if pos[u] == len(edges):
+            if not path:
+              break
+            level[u] = -1
+            e = path.pop()
+            u = to[e ^ 1]
+            pos[u] += 1
+            continue
+          path.append(e)
+          u = to[e]
+        if u != sink:
+          break
+        flow = min(cap[e] for e in path)
+        for e in path:
+          cap[e] -= flow
+          cap[e ^ 1] += flow
+        total += flow
+
+  def min_cost_flow(self, source, sink):
+    """ Send the maximum flow from source to sink at minimum cost.
+
+    Uses the primal-dual method: each phase computes shortest paths on
+    reduced costs and then saturates all shortest paths at once. All costs
+    must be non-negative. Returns the amount of flow.
+    """
+    potential = [0] * len(self.adj)
+    flow = 0
+    while True:
+      dist = self.shortest_paths(source, sink, potential)
+      if dist is None:
+        return flow
+      for v, d in enumerate(dist):
+        potential[v] += d
+      flow += self.augment(source, sink, potential)
+
+def read_preferences(fname, pcdb):
+  """ Read review preferences from a HotCRP CSV.
+
+  The file needs paper, email (or user) and preference columns, as written by
+  export2hotcrp.export_review_preferences. Returns a dict from (paper id,
+  member id) to preference.
+  """
+  # Look up emails in a dict rather than scanning the PC for every row. The
+  # first member with an email wins, as with pcdb.getid.
+  ids = {}
+  for member in pcdb:
+    ids.setdefault(member.email, member.id)
+  preferences = {}
+  with open(fname, "r") as f:
+    reader = csv.DictReader(f, delimiter=",")
+    for row in reader:
+      email = row.get("email") or row.get("user")
+      if not row.get("preference") or not email:
+        continue
+      pcid = ids.get(email)
+      if pcid is None:
+        continue
+      preferences[(int(row["paper"]), pcid)] = int(float(row["preference"]))
+  return preferences
+
+def topic_matrix(objs, topics):
+  """ The objs x topics 0/1 matrix of declared topics. """
+  index = dict((t, i) for i, t in enumerate(topics))
+  matrix = np.zeros((len(objs), len(topics)), dtype=np.int64)
+  for k, obj in enumerate(objs):
+    for topic in obj.topics:
+      if topic in index:
+        matrix[k, index[topic]] = 1
+  return matrix
+
+def candidate_values(papers, reviewers, preferences, pref_weight, topic_weight):
+  """ Compute the papers x reviewers matrices of assignment values.
+
+  Returns (values, allowed), where allowed is False for conflicted pairs.
+  """
+  topics = sorted(set(t for obj in papers + reviewers for t in obj.topics))
+  overlap = topic_matrix(papers, topics).dot(topic_matrix(reviewers, topics).T)
+  prefs = np.zeros((len(papers), len(reviewers)), dtype=np.int64)
+  paper_index = dict((paper.id, i) for i, paper in enumerate(papers))
+  reviewer_index = dict((member.id, j) for j, member in enumerate(reviewers))
+  for (pid, mid), pref in preferences.iteritems():
+    if pid in paper_index and mid in reviewer_index:
+      prefs[paper_index[pid], reviewer_index[mid]] = pref
+
+  allowed = prefs > PREF_CONFLICT
+  for i, paper in enumerate(papers):
+    for member in paper.pc_conflicts:
+      if member.id in reviewer_index:
+        allowed[i, reviewer_index[member.id]] = False
+    for author in paper.authors:
+      if author.id in reviewer_index and author.is_pc:
+        allowed[i, reviewer_index[author.id]] = False
+  return pref_weight * prefs + topic_weight * overlap, allowed
+
+def assign_reviewers(papers, reviewers, preferences, reviews_per_paper=3,
+                     max_load=None, max_candidates=40, pref_weight=1,
+                     topic_weight=10):
+  """ Assign reviewers to papers with the largest total value.
+
+  reviews_per_paper is either a number or a dict from paper id to number.
+  max_load defaults to an even share of all the reviews, plus one.
+  Returns a list of (paper, reviewer) pairs and the total value. Papers that
+  could not get all their reviews are printed.
+  """
+  if not isinstance(reviews_per_paper, dict):
+    reviews_per_paper = dict((paper.id, reviews_per_paper) for paper in papers)
+  demand = sum(reviews_per_paper.get(paper.id, 0) for paper in papers)
+  if max_load is None:
+    max_load = -(-demand // max(len(reviewers), 1)) + 1
+
+  values, allowed = candidate_values(
+      papers, reviewers, preferences, pref_weight, topic_weight)
+  # Column order of each row from the most to the least valuable reviewer.
+  order = np.argsort(np.where(allowed, -values, 1 << 40), axis=1,
+                     kind="mergesort")
+  top = values.max() if values.size else 0
+
+  def solve(num_candidates):
+    """ Run min-cost flow over each paper's num_candidates best reviewers. """
+    # Nodes: source, papers, reviewers, sink.
+    source = 0
+    sink = len(papers) + len(reviewers) + 1
+    graph = FlowGraph(sink + 1)
+    edges = []
+    for i, paper in enumerate(papers):
+      graph.add_edge(source, 1 + i, reviews_per_paper.get(paper.id, 0), 0)
+      for j in order[i, :num_candidates].tolist():
+        if allowed[i, j]:
+          # Costs are shifted to be non-negative. Every unit of flow crosses
+          # exactly one of these edges, so this does not change the optimum.
+          e = graph.add_edge(1 + i, 1 + len(papers) + j, 1,
+                             int(top - values[i, j]))
+          edges.append((e, i, j))
+    for j in range(len(reviewers)):
+      graph.add_edge(1 + len(papers) + j, sink, max_load, 0)
+    return graph, edges, graph.min_cost_flow(source, sink)
+
+  graph, edges, flow = solve(min(max_candidates, len(reviewers)))
+  if flow < demand and max_candidates < len(reviewers):
+    # Pruning the candidates can make a tight max_load infeasible, so try
+    # again with every reviewer.
+    print "Only %d of %d reviews fit the %d best candidates per paper; " \
+        "retrying with all reviewers" % (flow, demand, max_candidates)
+    graph, edges, flow = solve(len(reviewers))
+
+  result = []
+  total = 0
+  assigned = np.zeros(len(papers), dtype=np.int64)
+  for e, i, j in edges:
+    if graph.cap[e] == 0:
+      result.append((papers[i], reviewers[j]))
+      total += int(values[i, j])
+      assigned[i] += 1
+  for i, paper in enumerate(papers):
+    missing = reviews_per_paper.get(paper.id, 0) - assigned[i]
+    if missing > 0:
+      print "Paper %d is missing %d reviews" % (paper.id, missing)
+  return result, total
+
+def export_assignments(fname, assignments, action="primary"):
+  """ Write the assignments as a HotCRP bulk assignment CSV. """
+  with open(fname, "w") as f:
+    writer = csv.writer(f, delimiter=",")
+    writer.writerow(["paper", "assignment", "email"])
+    for paper, member in sorted(assignments, key=lambda a: (a[0].id, a[1].id)):
+      writer.writerow([paper.id, action, member.email])
@@ -1,7 +1,14 @@
 # Base database class and other common methods.
 
 from bisect import bisect_left, bisect
+import cPickle as pickle
+import multiprocessing
+import os
+import random
+import time
+
 from fuzzywuzzy import process, fuzz
+import numpy as np
 
 def dict_default(dictobj, key, default):
   """ If key exists in dictobj, return the value, otherwise return default. """
@@ -10,6 +17,206 @@ def dict_default(dictobj, key, default):
   return default
 
 
+def derive_seeds(master_seed, count):
+  """ Deterministically derive count worker seeds from master_seed. """
+  rng = random.Random(master_seed)
+  return [rng.randint(0, 2**31 - 1) for i in range(count)]
+
+def seed_rngs(seed):
+  """ Seed both the random and numpy.random global generators. """
+  random.seed(seed)
+  np.random.seed(seed)
+
+class TrialSearch(object):
+  # Bookkeeping for an anytime search made of repeated random trials.
+  #
+  # The search stops after a number of trials, a wall-clock budget in seconds
+  # or once a target score is reached, whichever comes first. Progress is
+  # printed on every improvement and every report_interval seconds. If a
+  # checkpoint file is given, the best solution, trial count and random number
+  # generator states are saved to it every checkpoint_interval seconds so that
+  # an interrupted search can resume where it stopped. A checkpoint left by a
+  # different search is neither used nor touched.
+
+  def __init__(self, trials, budget=None, target=None, checkpoint=None,
+               ties=False, label="search", report_interval=30,
+               checkpoint_interval=300):
+    self.trials = trials
+    self.budget = budget
+    self.target = target
+    self.checkpoint = checkpoint
+    self.ties = ties
+    self.label = label
+    self.report_interval = report_interval
+    self.checkpoint_interval = checkpoint_interval
+
+    self.trial = 0
+    self.min_score = None
+    self.best = None
+    # Whether the checkpoint file was loaded or written by this search.
+    self.owns_checkpoint_ = False
+
+    self.start_ = time.time()
+    self.start_trial_ = 0
+    self.last_improvement_ = self.start_
+    self.last_report_ = self.start_
+    self.last_checkpoint_ = self.start_
+
+  def resume(self):
+    """ Restore the search state from the checkpoint file, if there is one. """
+    if not self.checkpoint or not os.path.exists(self.checkpoint):
+      return False
+    with open(self.checkpoint, "rb") as f:
+      state = pickle.load(f)
+    if state["label"] != self.label:
+      print "Ignoring checkpoint %s from %s; not checkpointing %s" % (
+          self.checkpoint, state["label"], self.label)
+      self.checkpoint = None
+      return False
+    self.trial = state["trial"]
+    self.start_trial_ = self.trial
+    self.min_score = state["min_score"]
+    self.best = state["best"]
+    random.setstate(state["random_state"])
+    np.random.set_state(state["np_random_state"])
+    self.owns_checkpoint_ = True
+    print "%s: resuming at trial %d, best %s" % (
+        self.label, self.trial, self.min_score)
+    return True
+
+  def save(self):
+    """ Write the current search state to the checkpoint file. """
+    if not self.checkpoint:
+      return
+    state = {"label": self.label,
+             "trial": self.trial,
+             "min_score": self.min_score,
+             "best": self.best,
+             "random_state": random.getstate(),
+             "np_random_state": np.random.get_state()}
+    with open(self.checkpoint + ".tmp", "wb") as f:
+      pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(self.checkpoint + ".tmp", self.checkpoint)
+    self.owns_checkpoint_ = True
+    self.last_checkpoint_ = time.time()
+
+  def finished(self):
+    """ True once all trials ran or the target score was reached. """
+    return (self.trial >= self.trials or
+            (self.target is not None and self.min_score is not None and
+             self.min_score <= self.target))
+
+  def running(self):
+    """ Check the stopping conditions before the next trial.
+
+    The budget never stops a search before its first trial, so there is
+    always a result.
+    """
+    now = time.time()
+    if now - self.last_report_ >= self.report_interval:
+      self.report(now)
+    if self.checkpoint and now - self.last_checkpoint_ >= self.checkpoint_interval:
+      self.save()
+    if self.finished():
+      return False
+    return (self.budget is None or self.min_score is None or
+            now - self.start_ < self.budget)
+
+  def record(self, score):
+    """ Count a trial. Returns True if its solution should become the best. """
+    self.trial += 1
+    if self.min_score is None or score < self.min_score:
+      self.min_score = score
+      self.last_improvement_ = time.time()
+      self.report(self.last_improvement_)
+      return True
+    return self.ties and score == self.min_score
+
+  def report(self, now):
+    """ Print one line of progress. """
+    elapsed = max(now - self.start_, 1e-9)
+    print ("%s: trial=%d trials_per_sec=%.1f best=%s "
+           "secs_since_improvement=%.1f" % (
+               self.label, self.trial, (self.trial - self.start_trial_) / elapsed,
+               self.min_score, now - self.last_improvement_))
+    self.last_report_ = now
+
+  def close(self):
+    """ Keep the checkpoint of an unfinished search, otherwise remove it. """
+    self.report(time.time())
+    if not self.checkpoint:
+      return
+    if self.finished():
+      if self.owns_checkpoint_ and os.path.exists(self.checkpoint):
+        os.remove(self.checkpoint)
+    else:
+      self.save()
+
+def run_worker_trials(task):
+  """ Seed this process and run a block of trials. Used by run_trials.
+
+  The checkpoint is also saved when the trials are interrupted, e.g. with
+  Ctrl-C.
+  """
+  worker, args, seed, options = task
+  seed_rngs(seed)
+  search = TrialSearch(**options)
+  search.resume()
+  try:
+    worker(args, search)
+  finally:
+    search.close()
+  return search.min_score, search.best
+
+def run_trials(worker, args, trials, jobs=1, seed=None, ties=False,
+               budget=None, target=None, checkpoint=None,
+               checkpoint_interval=300):
+  """ Split trials among jobs processes and return the best (score, result).
+
+  worker(args, search) must be a module-level function that runs trials
+  while search.running(), calls search.record(score) for each of them and
+  sets search.best to the trial's result when record returns True. Lower
+  scores are better; with ties, later trials with an equal score replace the
+  best one. Each process is seeded with its own seed derived from seed, so
+  the same seed and number of jobs always produce the same result. Ties
+  between workers go to the lowest worker index.
+
+  budget, target, checkpoint and checkpoint_interval are passed to each
+  worker's TrialSearch. With several jobs, each worker keeps its own
+  checkpoint file.
+  """
+  jobs = max(1, min(jobs, trials))
+  seeds = derive_seeds(seed, jobs)
+  tasks = []
+  for i in range(jobs):
+    options = {"trials": trials // jobs + (i < trials % jobs),
+               "budget": budget,
+               "target": target,
+               "ties": ties,
+               "label": "%s[%d]" % (worker.__name__, i),
+               "checkpoint_interval": checkpoint_interval}
+    if checkpoint:
+      options["checkpoint"] = checkpoint if jobs == 1 else "%s.%d" % (checkpoint, i)
+    tasks.append((worker, args, seeds[i], options))
+
+  if jobs == 1:
+    results = [run_worker_trials(tasks[0])]
+  else:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(run_worker_trials, tasks)
+    finally:
+      pool.close()
+      pool.join()
+
+  best = min(range(jobs),
+             key=lambda i: (results[i][0] is None, results[i][0], i))
+  if results[best][0] is None:
+    raise RuntimeError("%s recorded no trials" % worker.__name__)
+  print "Best score %s from worker %d of %d (seed %d)" % (
+      results[best][0], best, jobs, tasks[best][2])
+  return results[best]
+
 class BaseObj(object):
   # Base object to be stored in a database.
 
@@ -89,8 +296,11 @@ class BaseDB(object):
         return result.id
       return -1
 
-  def find_closest(self, query, scorer=fuzz.ratio):
-    result = process.extractOne(query.upper(), self.names_, scorer=scorer)
+  def find_closest(self, query, scorer=fuzz.ratio, choices=None):
+    """ Fuzzy match query against choices (all names by default). """
+    if choices is None:
+      choices = self.names_
+    result = process.extractOne(query.upper(), choices, scorer=scorer)
     if not result:
       return None
     institution = result[0]
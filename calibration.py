@@ -0,0 +1,149 @@
+# Calibrate review scores for reviewer harshness and generosity.
+#
+# Paper.get_average_score treats all reviewers alike, so a paper that drew a
+# harsh reviewer ranks below an equally good paper that drew a generous one.
+# Two calibrations are available, both computed from the score table of a
+# ReviewDB (missing scores, which are 0, are ignored):
+#
+#   zscore: each score is replaced by the reviewer's z-score, and a paper's
+#     merit is the mean z-score of its reviews mapped back to the score scale.
+#   bias: scores are fit with the additive model
+#
+#       score = mean + paper merit + reviewer bias
+#
+#     by alternating least squares over the sparse papers x reviewers matrix.
+#     Reviewer biases are shrunk towards 0 by reviewer_reg, so a reviewer
+#     with few reviews cannot explain away a paper's scores.
+#
+# Both run in a handful of bincount calls per step, so rankings can be
+# recomputed interactively as post-rebuttal scores come in.
+
+import numpy as np
+import unicodecsv as csv
+
+import reviews
+
+POST_REBUTTAL_MERIT = "Post rebuttal overall merit"
+
+def observed_scores(reviewdb, category):
+  """ The (paper row, reviewer, score) arrays of the reviews with a score. """
+  table = reviewdb.score_table
+  scores = table[reviews.score_column(category)]
+  valid = scores > 0
+  return (reviewdb.paper_rows[valid], table["reviewer"][valid],
+          scores[valid].astype(np.float64))
+
+def missing_to_nan(values, counts):
+  """ Set the values with no observations to NaN. """
+  values = np.asarray(values, dtype=np.float64)
+  values[counts == 0] = np.nan
+  return values
+
+def zscore_calibration(reviewdb, category=POST_REBUTTAL_MERIT):
+  """ Calibrate scores with per-reviewer z-scores.
+
+  Reviewers with a single review or no spread in their scores are scaled by
+  the spread of all scores. Returns the calibrated merit of each paper (in
+  the order of reviewdb.paper_ids) and the mean offset of each reviewer (in
+  the order of reviewdb.reviewer_emails) from the mean of all scores.
+  """
+  paper_rows, reviewers, scores = observed_scores(reviewdb, category)
+  num_papers = len(reviewdb.paper_ids)
+  num_reviewers = len(reviewdb.reviewer_emails)
+  if len(scores) == 0:
+    return (np.full(num_papers, np.nan), np.full(num_reviewers, np.nan))
+  mean = scores.mean()
+  std = scores.std() or 1.0
+
+  reviewer_counts = np.bincount(reviewers, minlength=num_reviewers)
+  safe_counts = np.maximum(reviewer_counts, 1)
+  reviewer_means = np.bincount(reviewers, scores, num_reviewers) / safe_counts
+  reviewer_vars = (np.bincount(reviewers, scores ** 2, num_reviewers) /
+                   safe_counts - reviewer_means ** 2)
+  reviewer_stds = np.sqrt(np.maximum(reviewer_vars, 0))
+  reviewer_stds[(reviewer_counts < 2) | (reviewer_stds < 1e-9)] = std
+
+  z = (scores - reviewer_means[reviewers]) / reviewer_stds[reviewers]
+  paper_counts = np.bincount(paper_rows, minlength=num_papers)
+  merit = (mean + std * np.bincount(paper_rows, z, num_papers) /
+           np.maximum(paper_counts, 1))
+  return (missing_to_nan(merit, paper_counts),
+          missing_to_nan(reviewer_means - mean, reviewer_counts))
+
+def bias_calibration(reviewdb, category=POST_REBUTTAL_MERIT, reviewer_reg=1.0,
+                     max_iterations=1000, tolerance=1e-9):
+  """ Calibrate scores with the additive reviewer-bias model.
+
+  Alternates between the least squares paper merits given the reviewer
+  biases and the (regularized) biases given the merits, until no value moves
+  by more than tolerance. Returns the merit of each paper (mean plus its
+  merit term, in the order of reviewdb.paper_ids) and the bias of each
+  reviewer (in the order of reviewdb.reviewer_emails).
+  """
+  paper_rows, reviewers, scores = observed_scores(reviewdb, category)
+  num_papers = len(reviewdb.paper_ids)
+  num_reviewers = len(reviewdb.reviewer_emails)
+  if len(scores) == 0:
+    return (np.full(num_papers, np.nan), np.full(num_reviewers, np.nan))
+  mean = scores.mean()
+  residual = scores - mean
+
+  paper_counts = np.bincount(paper_rows, minlength=num_papers)
+  paper_norm = np.maximum(paper_counts, 1)
+  reviewer_counts = np.bincount(reviewers, minlength=num_reviewers)
+  reviewer_norm = reviewer_counts + reviewer_reg
+  reviewer_norm[reviewer_norm == 0] = 1
+
+  merit = np.zeros(num_papers)
+  bias = np.zeros(num_reviewers)
+  for it in range(max_iterations):
+    new_merit = (np.bincount(paper_rows, residual - bias[reviewers],
+                             num_papers) / paper_norm)
+    new_bias = (np.bincount(reviewers, residual - new_merit[paper_rows],
+                            num_reviewers) / reviewer_norm)
+    change = max(np.abs(new_merit - merit).max(), np.abs(new_bias - bias).max())
+    merit, bias = new_merit, new_bias
+    if change < tolerance:
+      break
+  return (missing_to_nan(mean + merit, paper_counts),
+          missing_to_nan(bias, reviewer_counts))
+
+CALIBRATIONS = {"zscore": zscore_calibration, "bias": bias_calibration}
+
+def rank_papers(reviewdb, method="bias", category=POST_REBUTTAL_MERIT):
+  """ Rank the reviewed papers by calibrated merit.
+
+  Returns a list of (paper id, calibrated merit, mean score, number of
+  reviews) from the best paper down, and the reviewer biases of the method.
+  Papers without scores come last.
+  """
+  merit, bias = CALIBRATIONS[method](reviewdb, category)
+  paper_rows, reviewers, scores = observed_scores(reviewdb, category)
+  counts = np.bincount(paper_rows, minlength=len(reviewdb.paper_ids))
+  means = missing_to_nan(
+      np.bincount(paper_rows, scores, len(counts)) / np.maximum(counts, 1),
+      counts)
+  # Sort by merit, then mean score, from the top; NaNs sort last.
+  order = np.lexsort((-np.nan_to_num(means), np.isnan(means),
+                      -np.nan_to_num(merit), np.isnan(merit)))
+  ranking = [(int(reviewdb.paper_ids[i]), float(merit[i]), float(means[i]),
+              int(counts[i])) for i in order]
+  return ranking, bias
+
+def export_ranking(fname, ranking):
+  """ Write a ranking from rank_papers as a CSV. """
+  with open(fname, "w") as f:
+    writer = csv.writer(f, delimiter=",")
+    writer.writerow(["rank", "paper", "calibrated", "mean", "reviews"])
+    for rank, (paper_id, merit, mean, count) in enumerate(ranking):
+      writer.writerow([rank + 1, paper_id, "%.3f" % merit, "%.3f" % mean, count])
+
+def export_reviewer_biases(fname, reviewdb, bias, category=POST_REBUTTAL_MERIT):
+  """ Write each reviewer's bias and number of scores as a CSV. """
+  paper_rows, reviewers, scores = observed_scores(reviewdb, category)
+  counts = np.bincount(reviewers, minlength=len(reviewdb.reviewer_emails))
+  with open(fname, "w") as f:
+    writer = csv.writer(f, delimiter=",")
+    writer.writerow(["email", "bias", "reviews"])
+    for k in np.argsort(np.nan_to_num(bias), kind="mergesort"):
+      writer.writerow([reviewdb.reviewer_emails[k], "%.3f" % bias[k], counts[k]])
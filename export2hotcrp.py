@@ -1,69 +1,223 @@
 # Export functions for HotCRP.
+#
+# Bulk updates are written twice (see export_bulk_update): in full, as
+# before, and as a diff against the full file as it was last uploaded, which
+# only has the rows that were added or changed and rows undoing the ones that
+# went away. The uploaded version is kept in a separate file that only
+# changes once an upload is confirmed with mark_uploaded, so rerunning
+# before then diffs against the same upload. The diff can be split into
+# chunks of a fixed number of rows, so a failed upload only has to be retried
+# for one chunk.
 
+import glob
+import os
+import shutil
+import numpy as np
 import unicodecsv as csv
 
-def export_review_preferences(fname, outfname, pcdb):
-  """ Export review preferences as HotCRP bulk update. """
-  total_preferences = 0
-  updates = []
-  # New header.
-  updates.append(["paper", "assignment", "user", "preference"])
-  # updates.append(["paper", "assignment", "user", "tag"])
+def read_bulk_update(fname, header):
+  """ Read the rows of a bulk update CSV, or None if there is none.
+
+  A file with a different header counts as missing.
+  """
+  if not os.path.exists(fname):
+    return None
+  with open(fname, "r") as f:
+    reader = csv.reader(f, delimiter=",")
+    if reader.next() != header:
+      return None
+    return [row for row in reader]
+
+def write_bulk_update(fname, header, rows):
+  """ Write a bulk update CSV with the given header. """
+  with open(fname, "w") as f:
+    writer = csv.writer(f, delimiter=",", lineterminator="\n")
+    writer.writerow(header)
+    writer.writerows(rows)
+
+def uploaded_file(fname):
+  """ The file recording the last upload of bulk update fname. """
+  root, ext = os.path.splitext(fname)
+  return "%s-uploaded%s" % (root, ext)
+
+def diff_files(fname):
+  """ The diff files of bulk update fname that are on disk. """
+  root, ext = os.path.splitext(fname)
+  return sorted(glob.glob("%s-diff%s" % (root, ext)) +
+                glob.glob("%s-diff-*%s" % (root, ext)))
+
+def mark_uploaded(fname):
+  """ Record that the diff of bulk update fname was uploaded.
+
+  fname becomes the baseline of the next diffs, and its diff files are
+  removed.
+  """
+  shutil.copyfile(fname, uploaded_file(fname))
+  for diff_fname in diff_files(fname):
+    os.remove(diff_fname)
+  print "%s marked as uploaded" % fname
+
+def export_bulk_update(fname, header, rows, key_columns, undo,
+                       undo_changes=False, chunk_rows=None, keep=None):
+  """ Write a bulk update CSV in full and as a diff against its last upload.
+
+  Rows with the same values in key_columns are the same update. The diff has
+  the rows that are new or changed since the upload recorded by
+  mark_uploaded (everything if there was none), and undo(row) for every
+  uploaded row that is gone. With undo_changes, a changed row is undone
+  before its new version (for updates that do not replace each other, like
+  tags). If keep is given, rows for which keep(row) is false are left out of
+  the full file and are never undone.
+
+  The diff is written to fname with a -diff suffix, or to numbered files of
+  at most chunk_rows rows each (e.g. update-diff-1.csv), each with the
+  header. Returns the names of the diff files.
+  """
+  header = [unicode(h) for h in header]
+  rows = [[unicode(value) for value in row] for row in rows]
+  if keep is not None:
+    rows = [row for row in rows if keep(row)]
+  key = lambda row: tuple(row[c] for c in key_columns)
+  previous = read_bulk_update(uploaded_file(fname), header) or []
+  previous_rows = dict((key(row), row) for row in previous)
+
+  diff = []
+  added = 0
+  changed = 0
+  current = set()
+  for row in rows:
+    current.add(key(row))
+    previous_row = previous_rows.get(key(row))
+    if previous_row is None:
+      added += 1
+    elif previous_row != row:
+      changed += 1
+      if undo_changes:
+        diff.append(undo(previous_row))
+    else:
+      continue
+    diff.append(row)
+  removed = [row for row in previous if key(row) not in current and
+             (keep is None or keep(row))]
+  diff.extend(undo(row) for row in removed)
+
+  write_bulk_update(fname, header, rows)
+  root, ext = os.path.splitext(fname)
+  if chunk_rows:
+    chunks = [diff[i:i + chunk_rows] for i in range(0, len(diff), chunk_rows)]
+    fnames = ["%s-diff-%d%s" % (root, k + 1, ext) for k in range(len(chunks))]
+  else:
+    chunks = [diff]
+    fnames = ["%s-diff%s" % (root, ext)]
+  # Diff files of an earlier run are only removed by mark_uploaded.
+  stale = [f for f in diff_files(fname) if f not in fnames]
+  for chunk_fname, chunk in zip(fnames, chunks):
+    write_bulk_update(chunk_fname, header, chunk)
+  print "%s: %d added, %d changed, %d removed; diff in %s" % (
+      fname, added, changed, len(removed), ", ".join(fnames) or "no files")
+  if stale:
+    print "Not part of this diff, from an earlier run: %s" % ", ".join(stale)
+  return fnames
+
+# Rows of the preference spreadsheet that are not PC members' preferences.
+PREFERENCE_EXCLUDE = ["DAVID BROOKS"]
+
+def read_preference_sheet(fname, pcdb, name_column=0, first_paper_column=3,
+                          exclude=PREFERENCE_EXCLUDE):
+  """ Read a preference spreadsheet into a sparse preference array.
+
+  The sheet has one row per PC member, named in name_column, and one column
+  per paper from first_paper_column on, with the paper ids in the header.
+  Cells that are not numbers ("C" for conflicts, or blank) are skipped, as
+  are rows with no name or a name in exclude.
+
+  Returns an int64 array of (pc id, paper id, preference) rows, in the order
+  of the sheet.
+  """
   with open(fname, "r") as f:
     reader = csv.reader(f, delimiter=",")
     header = reader.next()
-    # Papers start at column 4.
-    header = [int(pid) for pid in header[3:]]
-    num_papers = len(header)
-    print "Num papers:", num_papers
+    paper_ids = np.array([int(pid) for pid in header[first_paper_column:]],
+                         dtype=np.int64)
+    exclude = set(exclude)
+    names = []
+    cells = []
     for row in reader:
-      pcname = row[0]
-      if pcname == "DAVID BROOKS" or pcname == "":
+      if not row[name_column] or row[name_column] in exclude:
         continue
-      pcmember = pcdb[pcdb.getid(pcname)]
-      for col, paperid in enumerate(header):
-        pcpref = row[3+col]
-
-        # if pcpref == "C":
-        #   updates.append([paperid, "tag", pcmember.email, "Friday_DB_Conflict"])
-        # else:
-        #   continue
-
-        try:
-          pcpref = int(pcpref)*10
-        except (TypeError, ValueError) as e:
-          # This was probably either a "C" or a "".
-          continue
-        total_preferences += pcpref
-        updates.append([paperid, "preference", pcmember.email, pcpref])
-
-  with open(outfname, "w") as f:
-    writer = csv.writer(f, delimiter=",")
-    for row in updates:
-      writer.writerow(row)
-
-  print "total pref:", total_preferences
-
-def export_pc_partition_tags(fname, friday_group, saturday_group):
+      names.append(row[name_column])
+      row = row[first_paper_column:first_paper_column + len(paper_ids)]
+      cells.append(row + [u""] * (len(paper_ids) - len(row)))
+
+  ids = dict((member.name, member.id) for member in pcdb)
+  for name in names:
+    assert name in ids, "Unknown PC member %s" % name
+  pc_ids = np.array([ids[name] for name in names], dtype=np.int64)
+
+  # Sheets only hold a few distinct cell values, so each is parsed once.
+  values, inverse = np.unique(np.array(cells, dtype=np.unicode_),
+                              return_inverse=True)
+  numbers = np.zeros(len(values), dtype=np.int64)
+  numeric = np.zeros(len(values), dtype=bool)
+  for k, value in enumerate(values.tolist()):
+    try:
+      numbers[k] = int(value)
+      numeric[k] = True
+    except ValueError:
+      # This was probably either a "C" or a "".
+      pass
+  inverse = inverse.reshape(len(names), len(paper_ids))
+  rows, cols = np.nonzero(numeric[inverse])
+  prefs = numbers[inverse[rows, cols]]
+  return np.column_stack((pc_ids[rows], paper_ids[cols], prefs))
+
+def export_review_preferences(fname, outfname, pcdb, chunk_rows=None,
+                              name_column=0, first_paper_column=3,
+                              exclude=PREFERENCE_EXCLUDE, scale=10):
+  """ Export review preferences as HotCRP bulk update.
+
+  See read_preference_sheet for the layout of the sheet. Preferences are
+  multiplied by scale.
+  """
+  prefs = read_preference_sheet(fname, pcdb, name_column, first_paper_column,
+                                exclude)
+  prefs[:, 2] *= scale
+  print "Num preferences:", len(prefs)
+  emails = dict((member.id, member.email) for member in pcdb)
+  updates = [[paper_id, "preference", emails[pc_id], pref]
+             for pc_id, paper_id, pref in prefs.tolist()]
+
+  # A preference of 0 clears one that is no longer there.
+  export_bulk_update(outfname, ["paper", "assignment", "user", "preference"],
+                     updates, (0, 2),
+                     lambda row: [row[0], row[1], row[2], u"0"],
+                     chunk_rows=chunk_rows)
+
+  print "total pref:", int(prefs[:, 2].sum())
+
+def export_pc_partition_tags(fname, friday_group, saturday_group,
+                             chunk_rows=None):
   """ Update PC member tags with their respective Friday/Saturday tags. """
-  with open(fname, "w") as f:
-    writer = csv.writer(f, delimiter=",")
-    updates = []
-    updates.append(["email","add_tags","remove_tags"])
-    combined_groups = set(friday_group) | set(saturday_group)
-    for pc_member in combined_groups:
-      if "PC_Either" in pc_member.tags:
-        if pc_member in friday_group:
-          updates.append([pc_member.email, "PC_Friday,PC_Either_orig", "PC_Either"])
-        else:
-          updates.append([pc_member.email, "PC_Saturday,PC_Either_orig", "PC_Either"])
-      elif "PC_Both" in pc_member.tags:
-        if pc_member in friday_group and pc_member in saturday_group:
-          updates.append([pc_member.email, "PC_Friday,PC_Saturday,PC_Both_orig", "PC_Both"])
-        elif pc_member in friday_group:
-          updates.append([pc_member.email, "PC_Friday,PC_Both_orig", "PC_Both"])
-        else:
-          updates.append([pc_member.email, "PC_Saturday,PC_Both_orig", "PC_Both"])
-
-    for row in updates:
-      writer.writerow(row)
+  updates = []
+  header = ["email","add_tags","remove_tags"]
+  friday_ids = set(m.id for m in friday_group)
+  saturday_ids = set(m.id for m in saturday_group)
+  combined_groups = dict((m.id, m) for m in friday_group + saturday_group)
+  for pc_member in combined_groups.itervalues():
+    if "PC_Either" in pc_member.tags:
+      if pc_member.id in friday_ids:
+        updates.append([pc_member.email, "PC_Friday,PC_Either_orig", "PC_Either"])
+      else:
+        updates.append([pc_member.email, "PC_Saturday,PC_Either_orig", "PC_Either"])
+    elif "PC_Both" in pc_member.tags:
+      if pc_member.id in friday_ids and pc_member.id in saturday_ids:
+        updates.append([pc_member.email, "PC_Friday,PC_Saturday,PC_Both_orig", "PC_Both"])
+      elif pc_member.id in friday_ids:
+        updates.append([pc_member.email, "PC_Friday,PC_Both_orig", "PC_Both"])
+      else:
+        updates.append([pc_member.email, "PC_Saturday,PC_Both_orig", "PC_Both"])
+
+  # A tag update is undone by swapping the added and removed tags.
+  export_bulk_update(fname, header, updates, (0,),
+                     lambda row: [row[0], row[2], row[1]],
+                     undo_changes=True, chunk_rows=chunk_rows)
@@ -1,11 +1,37 @@
 # Reads the institution name database.
 
 from bisect import bisect_left
+import cPickle as pickle
+import hashlib
+import os
 import re
 
 from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils as fuzz_utils
 import base
 
+# Bump this whenever the layout of the compiled index changes.
+INDEX_VERSION = 3
+INDEX_SUFFIX = ".index"
+NGRAM_SIZE = 3
+
+inst_re = re.compile("UNIVERSITY|COLLEGE")
+
+def normalize_name(name):
+  """ Remove "University" and "College" and upper case the name. """
+  return inst_re.sub("", name.upper())
+
+def ngrams(name):
+  """ Return the set of character n-grams of a (padded) name.
+
+  The name is first processed like fuzzywuzzy processes the strings it
+  scores (punctuation becomes spaces, lower case), so "A & M" and "A&M" share
+  n-grams.
+  """
+  padded = " %s " % fuzz_utils.full_process(name, force_ascii=True)
+  return set(padded[i:i+NGRAM_SIZE]
+             for i in range(max(1, len(padded) - NGRAM_SIZE + 1)))
+
 class Institution(base.BaseObj):
   _id = 0
 
@@ -45,6 +71,25 @@ class InstDB(base.BaseDB):
         self.names_.append(name)
     self.pairs_.sort(key=lambda tup: tup[0])
     self.names_.sort()
+    self.build_fuzzy_index()
+
+  def build_fuzzy_index(self):
+    """ Build n-gram postings over the sorted names.
+
+    postings_ maps each n-gram to the positions in names_ containing it.
+    """
+    postings = {}
+    for pos, name in enumerate(self.names_):
+      for gram in ngrams(name):
+        postings.setdefault(gram, []).append(pos)
+    self.postings_ = postings
+
+  def candidate_names(self, query):
+    """ Names sharing at least one n-gram with query, in names_ order. """
+    positions = set()
+    for gram in ngrams(query):
+      positions.update(self.postings_.get(gram, ()))
+    return [self.names_[pos] for pos in sorted(positions)]
 
   def find_exact_or_closest(self, instname, scorer=fuzz.token_set_ratio):
     """ Find either an exact match or a very close match. """
@@ -56,8 +101,13 @@ class InstDB(base.BaseDB):
     if instid != -1:
       return instid
 
-    # Find closest match to this institution.
-    match = self.find_closest(instname, scorer=scorer)
+    # Find closest match to this institution. Anything scoring high enough to
+    # be accepted shares n-grams of the processed strings fuzzywuzzy compares
+    # with the query, so only score those names.
+    candidates = self.candidate_names(instname)
+    if not candidates:
+      return -1
+    match = self.find_closest(instname, scorer=scorer, choices=candidates)
     if not match:
       return -1
     score = match["score"]
@@ -65,17 +115,75 @@ class InstDB(base.BaseDB):
       return match["id"]
     return -1
 
-def read_instdb(fname):
+def parse_instdb(data):
+  """ Build an InstDB from the raw contents of an institutions CSV. """
   institutions = []
-  with open(fname, "rb") as f:
-    for line in f:
-      line = unicode(line, encoding="utf-8")
-      split = line.split(",")
-      # Remove "University" and "College"
-      processed = []
-      for s in split:
-        s = re.sub("UNIVERSITY|COLLEGE", "", s.upper())
-        processed.append(s)
-      institutions.append(Institution(processed))
+  for line in data.splitlines():
+    line = unicode(line, encoding="utf-8")
+    split = line.split(",")
+    # Remove "University" and "College"
+    processed = [normalize_name(s) for s in split]
+    institutions.append(Institution(processed))
 
   return InstDB(institutions)
+
+def compile_instdb(fname, index_fname=None):
+  """ Compile the institutions CSV into a binary index next to it.
+
+  The index stores the fully built InstDB (aliases, normalized sorted keys
+  and n-gram postings) along with the hash of the CSV it was
+  built from.
+  """
+  if index_fname is None:
+    index_fname = fname + INDEX_SUFFIX
+  with open(fname, "rb") as f:
+    data = f.read()
+  instdb = parse_instdb(data)
+  index = {"version": INDEX_VERSION,
+           "csv_hash": hashlib.sha1(data).hexdigest(),
+           "instdb": instdb}
+  with open(index_fname, "wb") as f:
+    pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+  return instdb
+
+def load_compiled_instdb(fname, index_fname=None):
+  """ Load the compiled index of fname if it is current, otherwise None. """
+  if index_fname is None:
+    index_fname = fname + INDEX_SUFFIX
+  if not os.path.exists(index_fname):
+    return None
+  with open(fname, "rb") as f:
+    csv_hash = hashlib.sha1(f.read()).hexdigest()
+  try:
+    with open(index_fname, "rb") as f:
+      index = pickle.load(f)
+  except (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+          ValueError, KeyError, IndexError, TypeError):
+    # Missing classes or a corrupt index; it is simply compiled again.
+    return None
+  if (not isinstance(index, dict) or
+      index.get("version") != INDEX_VERSION or
+      index.get("csv_hash") != csv_hash):
+    return None
+
+  # New institutions must not reuse the ids of the loaded ones.
+  instdb = index["instdb"]
+  if instdb.orig:
+    Institution._id = max(Institution._id, max(instdb.orig.iterkeys()) + 1)
+  return instdb
+
+def read_instdb(fname):
+  """ Read the institutions CSV, reusing its compiled index when current. """
+  instdb = load_compiled_instdb(fname)
+  if instdb is not None:
+    return instdb
+  print "Compiling institution index for", fname
+  return compile_instdb(fname)
+
+if __name__ == "__main__":
+  # Pickle through the institutions module, so the index refers to
+  # institutions.InstDB rather than __main__.InstDB.
+  import sys
+  import institutions
+  for fname in sys.argv[1:]:
+    institutions.compile_instdb(fname)
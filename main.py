@@ -4,12 +4,16 @@
 
 import argparse
 import cPickle as pickle
+import random
 import sys
 import re
 from fuzzywuzzy import fuzz
 
+import assignment
+import calibration
 import export2hotcrp
 import institutions
+import partitionjoint
 import partitionpapers
 import partitionpc
 import programcommittee
@@ -124,16 +128,37 @@ def import_update_csv(fname):
       assert(pcid != -1)
       paperdb[pid].pc_conflicts.add(pcdb[pcid])
 
-def export_update_csv(suff=""):
-  update_csv = open("update%s.csv" % suff, "w")
-  update_csv.write("paper,assignment,email\n")
+def export_update_csv(suff="", chunk_rows=None):
+  """ Export the conflicts found as a HotCRP bulk update.
+
+  Call this before subtract_orig_pc_conflicts: the conflicts the authors
+  declared are left out of the update, but are never cleared by its diff.
+  """
+  updates = []
+  declared = set()
   for paper in paperdb:
     conflicts = sorted(paper.pc_conflicts)
     for conflict in conflicts:
-      row = "{0},{1},{2}\n".format(paper.id, "conflict", conflict.email)
-      update_csv.write(row)
-
-  update_csv.close()
+      updates.append([paper.id, "conflict", conflict.email])
+    for conflict in paper.orig_pc_conflicts:
+      declared.add((unicode(paper.id), conflict.email))
+  export2hotcrp.export_bulk_update(
+      "update%s.csv" % suff, ["paper", "assignment", "email"], updates,
+      (0, 1, 2), lambda row: [row[0], "clearconflict", row[2]],
+      chunk_rows=chunk_rows, keep=lambda row: (row[0], row[2]) not in declared)
+
+def optimize_paper_partition(pc_groups, random_groups):
+  """ Run the deterministic paper partitioner next to the random baseline. """
+  paper_groups, score = partitionpapers.optimize_paper_partition(
+      pc_groups, paperdb)
+  day_ids = [partitionpc.member_ids(group) for group in pc_groups]
+  for label, groups in (("Random baseline", random_groups),
+                        ("Optimized", paper_groups)):
+    conflicts = sum(partitionpapers.compute_combined_score(papers, ids)
+                    for papers, ids in zip(groups, day_ids))
+    sizes = "/".join(str(len(papers)) for papers in groups)
+    print "%s conflicts: %d (papers per day: %s)" % (label, conflicts, sizes)
+  return paper_groups
 
 def clear_pc_conflicts():
   for paper in paperdb:
@@ -164,6 +189,24 @@ def store_to_pickle_file(paperdb, pcdb, instdb, reviewdb):
   with open("data.pickle", "wb") as f:
     pickle.dump(obj, f)
 
+def update_reviews(fname, prefix, jobs):
+  """ Bring the pickled reviews up to date with a newer review dump. """
+  global reviewdb
+  if reviewdb is None:
+    reviewdb = reviews.read_reviewdb(fname, prefix, jobs)
+    reviews.merge_with_paperdb(reviewdb, paperdb)
+    print "Read %d reviews" % len(reviewdb.reviews)
+  else:
+    added, changed, removed = reviews.update_reviewdb(
+        reviewdb, fname, prefix, paperdb)
+    print "Reviews: %d added, %d changed, %d removed" % (
+        len(added), len(changed), len(removed))
+    for label, names in [("Added:", added), ("Changed:", changed),
+                         ("Removed:", removed)]:
+      if names:
+        print label, ", ".join(names)
+  store_to_pickle_file(paperdb, pcdb, instdb, reviewdb)
+
 def main():
   parser = argparse.ArgumentParser()
   parser.add_argument("paperdb", help="JSON dump of all submissions.")
@@ -172,12 +215,32 @@ def main():
       help="CSV file of all institutions and possible spellings.")
   parser.add_argument("mode",
       choices=["analyze-topics", "find-conflicts", "mark-collaborators",
-               "partition-pc", "partition-papers", "export-preferences",
+               "partition-pc", "partition-papers", "partition-joint",
+               "assign-reviews", "export-preferences",
                "export-pc-partition-tags", "merge-conflicts-assignments",
-               "pc-chair-coi", "pc-meeting-plots", "upload-reviews"])
+               "pc-chair-coi", "pc-meeting-plots", "upload-reviews",
+               "calibrate-scores"])
   parser.add_argument("--load", action="store_true",
       help="Load a pickle file.")
   parser.add_argument("--review-file", help="Dump of all reviews.")
+  parser.add_argument("--review-prefix", default=reviews.REVIEW_PREFIX,
+      help="Text before the review id in each review header of the dump.")
+  parser.add_argument("--calibration", default="bias",
+      choices=sorted(calibration.CALIBRATIONS),
+      help="How calibrate-scores corrects for reviewer bias: per-reviewer "
+      "z-scores or an additive reviewer-bias model.")
+  parser.add_argument("--upload-size-limit", type=float,
+      help="Split the upload-reviews forms into files of at most this many "
+      "MB, for HotCRP's upload limit.")
+  parser.add_argument("--chunk-rows", type=int,
+      help="Split the diffs of HotCRP bulk updates into files of at most this "
+      "many rows.")
+  parser.add_argument("--mark-uploaded", nargs="+", metavar="CSV",
+      help="Record that the diffs of these full bulk update CSVs were "
+      "uploaded, so later diffs are taken against them, then exit.")
+  parser.add_argument("--verify", action="store_true",
+      help="Also self-test partition-pc: check that incremental and "
+      "from-scratch smart merges agree.")
   parser.add_argument("--separate-steps", action="store_true",
       help="Separate conflict update csvs into each step.")
   parser.add_argument("--use-existing-paper-partitions", action="store_true",
@@ -185,20 +248,78 @@ def main():
       "regenerating them randomly.")
   parser.add_argument("--existing-update-csv",
       help="Import already generating conflict updates from this csv.")
+  parser.add_argument("--pc-strategy", default="smart",
+      choices=["random", "smart", "exact", "anneal"],
+      help="Strategy used to partition the PC.")
+  parser.add_argument("--storage-saturday", action="store_true",
+      help="Never put an Either or Both PC member with a storage topic on "
+      "Friday alone (partition-pc and two-day partition-joint).")
+  parser.add_argument("--time-limit", type=float,
+      help="Wall-clock limit in seconds for partition searches (the exact PC "
+      "strategy defaults to 600).")
+  parser.add_argument("--target-score", type=int,
+      help="Stop partition searches once this score is reached.")
+  parser.add_argument("--checkpoint",
+      help="Periodically save partition search progress to this file and "
+      "resume from it if it exists.")
+  parser.add_argument("--checkpoint-interval", type=float, default=300,
+      help="Seconds between saves of the --checkpoint file.")
+  parser.add_argument("--paper-strategy", default="random",
+      choices=["random", "optimal"],
+      help="Keep the best random paper partition, or optimize the conflicts "
+      "deterministically (the random result is still reported as a baseline).")
+  parser.add_argument("--long-spreadsheets", action="store_true",
+      help="Write paper spreadsheets as one (paper, pc, flag) row per "
+      "conflict, for groups too wide for spreadsheet tools.")
+  parser.add_argument("--num-days", type=int, default=2,
+      help="Number of meeting days (or parallel rooms) to partition into. "
+      "Anything other than 2 uses the PC_Day1..K, PC_Any and PC_All tags.")
+  parser.add_argument("--joint-weights", default="1,1,1",
+      help="Comma separated topic, conflict and load weights of the "
+      "partition-joint objective.")
+  parser.add_argument("--preferences",
+      help="HotCRP CSV of review preferences (paper, email, preference) for "
+      "assign-reviews.")
+  parser.add_argument("--preference-columns", default="0,3",
+      help="Column of the PC member names and first column of paper "
+      "preferences in the export-preferences spreadsheet.")
+  parser.add_argument("--preference-exclude", action="append",
+      help="Name of a spreadsheet row export-preferences skips (may be "
+      "repeated; defaults to the chair). Rows without a name are always "
+      "skipped.")
+  parser.add_argument("--reviews-per-paper", type=int, default=3,
+      help="Number of reviewers assign-reviews gives each paper.")
+  parser.add_argument("--max-load", type=int,
+      help="Most papers assign-reviews gives one reviewer (defaults to an "
+      "even share plus one).")
+  parser.add_argument("--jobs", type=int, default=1,
+      help="Number of worker processes for partition searches, parsing the "
+      "review dump and rendering plots.")
+  parser.add_argument("--seed", type=int,
+      help="Master random seed for partition searches. Printed if not given.")
 
   args = parser.parse_args()
+  if args.mark_uploaded:
+    for fname in args.mark_uploaded:
+      export2hotcrp.mark_uploaded(fname)
+    sys.exit()
+  if args.seed is None:
+    args.seed = random.randint(0, 2**31 - 1)
   global paperdb
   global pcdb
   global instdb
   global reviewdb
   if args.load:
     load_from_pickle_file()
+    if args.review_file:
+      update_reviews(args.review_file, args.review_prefix, args.jobs)
   else:
     paperdb = submissions.read_paperdb(args.paperdb)
     pcdb = programcommittee.read_pcdb(args.pcdb)
     instdb = institutions.read_instdb(args.instdb)
     if args.review_file:
-      reviewdb = reviews.read_reviewdb(args.review_file)
+      reviewdb = reviews.read_reviewdb(
+          args.review_file, args.review_prefix, args.jobs)
       reviews.merge_with_paperdb(reviewdb, paperdb)
 
     ########################################
@@ -222,20 +343,39 @@ def main():
 
   secondary.try_pre_process(args, paperdb, pcdb, instdb)
 
+  if args.mode == "partition-pc" and args.num_days != 2:
+    print "Random seed:", args.seed
+    groups = partitionpc.partition_pc_kway(
+        pcdb, args.num_days, jobs=args.jobs, seed=args.seed,
+        time_limit=args.time_limit, target=args.target_score,
+        checkpoint=args.checkpoint,
+        checkpoint_interval=args.checkpoint_interval)
+    for day, group in enumerate(groups):
+      partitionpc.print_partition(group, "day%d" % (day + 1), pcdb)
+    partitionpc.verify_kway_partition(groups)
+    sys.exit()
+
   if args.mode == "partition-pc":
-    friday, saturday = partitionpc.partition_pc(pcdb, "smart")
+    print "Random seed:", args.seed
+    friday, saturday = partitionpc.partition_pc(
+        pcdb, args.pc_strategy, args.time_limit, args.jobs, args.seed,
+        args.target_score, args.checkpoint, args.storage_saturday,
+        args.checkpoint_interval)
     partitionpc.print_partition(friday, "friday", pcdb)
     partitionpc.print_partition(saturday, "saturday", pcdb)
     partitionpc.print_partition_diff(friday, saturday, pcdb)
     partitionpc.verify_partition(friday, partitionpc.FRIDAY_TAG)
     partitionpc.verify_partition(saturday, partitionpc.SATURDAY_TAG)
+    partitionpc.verify_allowed_days(friday, saturday, args.storage_saturday)
     partitionpc.verify_all_pc_members_present(friday, saturday, pcdb)
+    if args.verify:
+      partitionpc.verify_incremental_merge(pcdb)
     sys.exit()
 
   if args.existing_update_csv:
     import_update_csv(args.existing_update_csv)
 
-  secondary.try_post_process(args, paperdb, pcdb, instdb)
+  secondary.try_post_process(args, paperdb, pcdb, instdb, reviewdb)
 
   # Run this function first, generate the stdout file, and fix everything, then
   # load that into read_step1_manual_file().
@@ -243,25 +383,26 @@ def main():
     mark_collaborators_on_pc_conflicts()
     return
 
-  if args.mode == "find-conflicts" or args.mode == "partition-papers":
+  if args.mode in ("find-conflicts", "partition-papers", "partition-joint",
+                   "assign-reviews"):
     if args.existing_update_csv:
       import_update_csv(args.existing_update_csv)
     else:
       if args.separate_steps:
         clear_pc_conflicts()
         read_step1_manual_file("results/step1_pcconflicts")
+        export_update_csv("_step1", args.chunk_rows)
         subtract_orig_pc_conflicts()
-        export_update_csv("_step1")
 
         clear_pc_conflicts()
         mark_pcs_in_author_institutions_conflicts()
+        export_update_csv("_step2", args.chunk_rows)
         subtract_orig_pc_conflicts()
-        export_update_csv("_step2")
 
         clear_pc_conflicts()
         mark_institutions_in_other_conflicts()
+        export_update_csv("_step3", args.chunk_rows)
         subtract_orig_pc_conflicts()
-        export_update_csv("_step3")
         print "With separate steps, we cannot do anything more."
         sys.exit()
 
@@ -271,15 +412,79 @@ def main():
         mark_pcs_in_author_institutions_conflicts()
         mark_institutions_in_other_conflicts()
 
+        export_update_csv("_combined", args.chunk_rows)
         subtract_orig_pc_conflicts()
-        export_update_csv("_combined")
+
+  if args.mode == "assign-reviews":
+    preferences = {}
+    if args.preferences:
+      preferences = assignment.read_preferences(args.preferences, pcdb)
+    papers = [paper for paper in paperdb]
+    reviewers = [member for member in pcdb if not member.is_epc]
+    assignments, total = assignment.assign_reviewers(
+        papers, reviewers, preferences, args.reviews_per_paper, args.max_load)
+    assignment.export_assignments("assignments.csv", assignments)
+    print "Assigned %d reviews, total value %d" % (len(assignments), total)
+    return
+
+  if args.mode == "partition-joint":
+    print "Random seed:", args.seed
+    weights = [float(w) for w in args.joint_weights.split(",")]
+    pc_groups, paper_groups, score = partitionjoint.partition_joint(
+        pcdb, paperdb, args.num_days, topic_weight=weights[0],
+        conflict_weight=weights[1], load_weight=weights[2], jobs=args.jobs,
+        seed=args.seed, time_limit=args.time_limit, target=args.target_score,
+        checkpoint=args.checkpoint, storage_saturday=args.storage_saturday,
+        checkpoint_interval=args.checkpoint_interval)
+    if args.num_days == 2:
+      labels = ["friday", "saturday"]
+    else:
+      labels = ["day%d" % (day + 1) for day in range(args.num_days)]
+    for label, papers, pc in zip(labels, paper_groups, pc_groups):
+      partitionpc.print_partition(pc, label, pcdb)
+      partitionpapers.export_paper_partition(papers, label)
+      partitionpapers.export_paper_spreadsheet(
+          papers, pc, label, args.long_spreadsheets)
+    parts = partitionjoint.verify_joint_partition(
+        pc_groups, paper_groups, score, partitionpc.TopicMatrix(pcdb), *weights,
+        storage_saturday=args.storage_saturday)
+    for name in ("topics", "conflicts", "author_clashes", "load"):
+      print "%s: %s" % (name, parts[name])
+    return
+
+  if args.mode == "partition-papers" and args.num_days != 2:
+    labels = ["day%d" % (day + 1) for day in range(args.num_days)]
+    pc_groups = [partitionpc.read_partition_file(
+        "pcpartitions/%s_group.txt" % label, pcdb) for label in labels]
+    if args.use_existing_paper_partitions:
+      paper_groups = [partitionpapers.import_paper_partition(
+          "paperpartitions/%s_papers.txt" % label, paperdb) for label in labels]
+    else:
+      print "Random seed:", args.seed
+      paper_groups = partitionpapers.partition_papers_kway(
+          pc_groups, paperdb, args.jobs, args.seed,
+          time_limit=args.time_limit, target=args.target_score,
+          checkpoint=args.checkpoint,
+          checkpoint_interval=args.checkpoint_interval)
+      if args.paper_strategy == "optimal":
+        paper_groups = optimize_paper_partition(pc_groups, paper_groups)
+    for label, papers, pc in zip(labels, paper_groups, pc_groups):
+      partitionpapers.export_paper_partition(papers, label)
+      partitionpapers.export_paper_spreadsheet(
+          papers, pc, label, args.long_spreadsheets)
+      print "%s score:" % label, partitionpapers.compute_combined_score(
+          papers, partitionpc.member_ids(pc))
+    return
 
   if args.mode == "partition-papers":
     friday_pc = partitionpc.read_partition_file(
         "pcpartitions/friday_group.txt", pcdb)
     saturday_pc = partitionpc.read_partition_file(
         "pcpartitions/saturday_group.txt", pcdb)
-    score = partitionpc.compute_combined_score(friday_pc, saturday_pc, {})
+    friday_ids = partitionpc.member_ids(friday_pc)
+    saturday_ids = partitionpc.member_ids(saturday_pc)
+    score = partitionpc.compute_combined_score(
+        friday_pc, saturday_pc, partitionpc.TopicMatrix(pcdb))
     print "PC score: ", score
     partitionpc.print_partition_diff(friday_pc, saturday_pc, pcdb)
     partitionpc.print_partition(friday_pc, "friday", pcdb)
@@ -291,24 +496,32 @@ def main():
       saturday_papers = partitionpapers.import_paper_partition(
           "paperpartitions/saturday_papers.txt", paperdb)
       friday_score = partitionpapers.compute_combined_score(
-          friday_papers, friday_pc)
+          friday_papers, friday_ids)
       saturday_score = partitionpapers.compute_combined_score(
-          saturday_papers, saturday_pc)
+          saturday_papers, saturday_ids)
       partitionpapers.export_paper_spreadsheet(
-          friday_papers, pcdb, "friday")
+          friday_papers, pcdb, "friday", args.long_spreadsheets)
       partitionpapers.export_paper_spreadsheet(
-          saturday_papers, pcdb, "saturday")
+          saturday_papers, pcdb, "saturday", args.long_spreadsheets)
       print "Friday score:", friday_score
       print "Saturday score:", saturday_score
     else:
+      print "Random seed:", args.seed
       friday_papers, saturday_papers = partitionpapers.partition_papers(
-          friday_pc, saturday_pc, paperdb)
+          friday_pc, saturday_pc, paperdb, args.jobs, args.seed,
+          time_limit=args.time_limit, target=args.target_score,
+          checkpoint=args.checkpoint,
+          checkpoint_interval=args.checkpoint_interval)
+      if args.paper_strategy == "optimal":
+        friday_papers, saturday_papers = optimize_paper_partition(
+            [friday_pc, saturday_pc], [friday_papers, saturday_papers])
       partitionpapers.export_paper_partition(friday_papers, "friday")
       partitionpapers.export_paper_partition(saturday_papers, "saturday")
       partitionpapers.export_paper_spreadsheet(
-          friday_papers, friday_pc, "friday")
+          friday_papers, friday_pc, "friday", args.long_spreadsheets)
       partitionpapers.export_paper_spreadsheet(
-          saturday_papers, saturday_pc, "saturday")
+          saturday_papers, saturday_pc, "saturday",
+          args.long_spreadsheets)
 
 if __name__ == "__main__":
   main()
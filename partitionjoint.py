@@ -0,0 +1,256 @@
+# Partition the PC and the papers into days at the same time.
+#
+# partition-pc balances topics without looking at the papers, and
+# partition-papers then has to live with the PC days it is given. Here both are
+# searched together under one weighted objective:
+#
+#   topic_weight * topic imbalance (partitionpc.compute_kway_score)
+#   + conflict_weight * conflicted PC members present for their papers
+#   + load_weight * imbalance of the number of papers per day
+#
+# A paper whose PC author is present on its day costs
+# partitionpapers.FORBIDDEN_DAY_COST instead of a single conflict, unless the
+# author is tagged to attend all days (PC_All, or PC_Both for two days): such
+# a paper cannot avoid its author, so it only counts as a regular conflict.
+
+import math
+import numpy as np
+
+import base
+import partitionpapers
+import partitionpc
+
+def pc_author(paper):
+  """ The id of the paper's first (non-ERC) PC author, or None. """
+  for author in paper.authors:
+    if author.is_pc and not author.is_epc:
+      return author.id
+  return None
+
+def attends_all_days(member):
+  """ True for members tagged to attend every day. """
+  return (partitionpc.ALL_TAG in member.tags or
+          partitionpc.BOTH_TAG in member.tags)
+
+def joint_day_choices(member, num_days, storage_saturday=False):
+  """ The sets of days open to a member, as in partitionpc.kway_day_choices.
+
+  For two days with storage_saturday, flexible storage members are kept off
+  Friday alone, like partitionpc.allowed_days does.
+  """
+  choices = partitionpc.kway_day_choices(member, num_days)
+  if (num_days == 2 and len(choices) > 1 and
+      partitionpc.saturday_only(member, storage_saturday)):
+    choices = [days for days in choices if days != (0,)]
+  return choices
+
+def paper_weights(papers, members):
+  """ For each member, list the (paper, cost) pairs it is in conflict with. """
+  member_index = dict((member.id, k) for k, member in enumerate(members))
+  weights = [{} for member in members]
+  for i, paper in enumerate(papers):
+    for member in paper.pc_conflicts:
+      if member.id in member_index:
+        weights[member_index[member.id]][i] = 1
+    author = pc_author(paper)
+    if (author in member_index and
+        not attends_all_days(members[member_index[author]])):
+      weights[member_index[author]][i] = partitionpapers.FORBIDDEN_DAY_COST
+  return [sorted(w.iteritems()) for w in weights]
+
+def joint_anneal_trials(args, search):
+  """ Anneal PC day picks and paper days together, keeping the best in search.
+
+  A move either puts one paper on another day or gives one flexible PC member
+  another of its allowed sets of days. Paper costs per day are kept up to
+  date, so a paper move costs O(1) and a member move O(days x member topics +
+  member conflicts). Scores are kept multiplied by the number of days.
+  """
+  (choices, rows, weights, num_papers, num_days, iterations, start_temp,
+   end_temp, topic_weight, conflict_weight, load_weight) = args
+  flexible = [k for k in range(len(choices)) if len(choices[k]) > 1]
+  topic_idx = [np.flatnonzero(row) for row in rows]
+  day_vectors = [[np.bincount(days, minlength=num_days)
+                  for days in member_choices] for member_choices in choices]
+  cooling = (end_temp / start_temp) ** (1.0 / max(iterations, 1))
+  conflict_weight *= num_days
+  num_moves = len(flexible) + num_papers
+  block = 65536
+
+  def load(size):
+    return load_weight * abs(num_days * size - num_papers)
+
+  while search.running():
+    picks = [np.random.randint(len(member_choices))
+             for member_choices in choices]
+    counts = np.zeros((num_days, rows.shape[1]), dtype=np.int64)
+    costs = np.zeros((num_papers, num_days), dtype=np.int64)
+    for k, pick in enumerate(picks):
+      counts += day_vectors[k][pick][:, np.newaxis] * rows[k]
+      for i, w in weights[k]:
+        costs[i] += w * day_vectors[k][pick]
+    assignment = [int(d) for d in np.argmin(costs, axis=1)]
+    sizes = [int(s) for s in np.bincount(assignment, minlength=num_days)]
+    costs = costs.tolist()
+
+    score = (topic_weight * np.abs(num_days * counts - counts.sum(axis=0)).sum() +
+             conflict_weight * sum(costs[i][d] for i, d in enumerate(assignment)) +
+             sum(load(s) for s in sizes))
+    min_score = score
+    best = (list(picks), list(assignment))
+
+    temp = start_temp * num_days
+    for it in xrange(iterations if num_moves else 0):
+      # Random numbers are drawn in blocks, which is much faster than one at
+      # a time.
+      if it % block == 0:
+        draws = np.random.random((3, block)).tolist()
+      move = int(draws[0][it % block] * num_moves)
+      other = draws[1][it % block]
+      accept = draws[2][it % block]
+      temp *= cooling
+      if move >= len(flexible):
+        i = move - len(flexible)
+        d = assignment[i]
+        e = int(other * (num_days - 1))
+        if e >= d:
+          e += 1
+        delta = (conflict_weight * (costs[i][e] - costs[i][d]) +
+                 load(sizes[d] - 1) - load(sizes[d]) +
+                 load(sizes[e] + 1) - load(sizes[e]))
+        if delta <= 0 or accept < math.exp(-delta / temp):
+          assignment[i] = e
+          sizes[d] -= 1
+          sizes[e] += 1
+          score += delta
+      else:
+        k = flexible[move]
+        pick = int(other * (len(choices[k]) - 1))
+        if pick >= picks[k]:
+          pick += 1
+        change = day_vectors[k][pick] - day_vectors[k][picks[k]]
+        idx = topic_idx[k]
+        old_block = counts[:, idx]
+        new_block = old_block + change[:, np.newaxis] * rows[k][idx]
+        delta = topic_weight * (
+            np.abs(num_days * new_block - new_block.sum(axis=0)).sum() -
+            np.abs(num_days * old_block - old_block.sum(axis=0)).sum())
+        change = change.tolist()
+        delta += conflict_weight * sum(w * change[assignment[i]]
+                                       for i, w in weights[k])
+        if delta <= 0 or accept < math.exp(-delta / temp):
+          counts[:, idx] = new_block
+          picks[k] = pick
+          for i, w in weights[k]:
+            cost = costs[i]
+            for d in range(num_days):
+              cost[d] += w * change[d]
+          score += delta
+      if score < min_score:
+        min_score = score
+        best = (list(picks), list(assignment))
+
+    if search.record(min_score / float(num_days)):
+      search.best = best
+
+def joint_score(pc_groups, paper_groups, topic_matrix,
+                topic_weight=1.0, conflict_weight=1.0, load_weight=1.0):
+  """ Score a joint partition from scratch with the PC and paper scorers.
+
+  Returns the weighted total and a dict of its unweighted parts: topics,
+  conflicts, author_clashes (papers on a day their PC author attends, for
+  authors who do not attend all days) and load.
+  """
+  num_days = len(pc_groups)
+  all_days_ids = set(m.id for group in pc_groups for m in group
+                     if attends_all_days(m))
+  day_ids = [partitionpc.member_ids(group) - all_days_ids
+             for group in pc_groups]
+  conflict_ids = [partitionpc.member_ids(group) for group in pc_groups]
+  group_counts = np.array([topic_matrix.counts(group) for group in pc_groups])
+  sizes = np.array([len(papers) for papers in paper_groups])
+  parts = {
+      "topics": partitionpc.compute_kway_score(group_counts),
+      "conflicts": sum(partitionpapers.compute_combined_score(papers, ids)
+                       for papers, ids in zip(paper_groups, conflict_ids)),
+      "author_clashes": sum(pc_author(paper) in ids
+                            for papers, ids in zip(paper_groups, day_ids)
+                            for paper in papers),
+      "load": np.abs(num_days * sizes - sizes.sum()).sum() / float(num_days),
+  }
+  # A PC author is usually one of the paper's conflicts as well.
+  author_conflicts = sum(
+      1 for papers, ids in zip(paper_groups, day_ids) for paper in papers
+      if pc_author(paper) in ids and
+      pc_author(paper) in set(m.id for m in paper.pc_conflicts))
+  total = (topic_weight * parts["topics"] +
+           conflict_weight * (parts["conflicts"] - author_conflicts +
+                              partitionpapers.FORBIDDEN_DAY_COST *
+                              parts["author_clashes"]) +
+           load_weight * parts["load"])
+  return total, parts
+
+def partition_joint(pcdb, paperdb, num_days=2, trials=4, iterations=1000000,
+                    start_temp=3.0, end_temp=0.2, topic_weight=1.0,
+                    conflict_weight=1.0, load_weight=1.0, jobs=1, seed=None,
+                    time_limit=None, target=None, checkpoint=None,
+                    storage_saturday=False, checkpoint_interval=300):
+  """ Partition the PC and the papers into num_days days together.
+
+  PC members may take any set of days allowed by their tags (see
+  joint_day_choices). Runs trials independent annealing runs of
+  joint_anneal_trials, spread over jobs processes; the search options are the
+  same as for partitionpc.partition_pc.
+
+  Returns the PC groups, the paper groups and the weighted score.
+  """
+  if num_days < 2:
+    raise ValueError("partition_joint needs at least 2 days, got %d" % num_days)
+  topic_matrix = partitionpc.TopicMatrix(pcdb)
+  members = [member for member in pcdb]
+  choices = [joint_day_choices(member, num_days, storage_saturday)
+             for member in members]
+  members = [m for m, c in zip(members, choices) if c]
+  choices = [c for c in choices if c]
+  rows = np.array([topic_matrix.row(member) for member in members],
+                  dtype=np.int64).reshape(len(members), len(topic_matrix.topics))
+  papers = [paper for paper in paperdb]
+  weights = paper_weights(papers, members)
+
+  min_score, best = base.run_trials(
+      joint_anneal_trials,
+      (choices, rows, weights, len(papers), num_days, iterations, start_temp,
+       end_temp, topic_weight, conflict_weight, load_weight),
+      trials, jobs, seed, budget=time_limit, target=target,
+      checkpoint=checkpoint, checkpoint_interval=checkpoint_interval)
+
+  best_picks, assignment = best
+  pc_groups = [[] for d in range(num_days)]
+  for member, member_choices, pick in zip(members, choices, best_picks):
+    for d in member_choices[pick]:
+      pc_groups[d].append(member)
+  paper_groups = [[] for d in range(num_days)]
+  for paper, d in zip(papers, assignment):
+    paper_groups[d].append(paper)
+  return pc_groups, paper_groups, min_score
+
+def verify_joint_partition(pc_groups, paper_groups, score, topic_matrix,
+                           topic_weight=1.0, conflict_weight=1.0,
+                           load_weight=1.0, storage_saturday=False):
+  """ Verify the PC days and the incrementally kept score from scratch. """
+  partitionpc.verify_kway_partition(pc_groups)
+  num_days = len(pc_groups)
+  members = {}
+  days = {}
+  for d, group in enumerate(pc_groups):
+    for member in group:
+      members[member.id] = member
+      days.setdefault(member.id, []).append(d)
+  for member_id, member_days in days.iteritems():
+    assert(tuple(member_days) in
+           joint_day_choices(members[member_id], num_days, storage_saturday))
+  total, parts = joint_score(pc_groups, paper_groups, topic_matrix,
+                             topic_weight, conflict_weight, load_weight)
+  assert(abs(total - score) <= 1e-6 * max(1.0, abs(total)))
+  print "Joint score verified:", total
+  return parts
@@ -1,71 +1,243 @@
-# Partition papers into Friday/Saturday groups.
+# Partition papers into Friday/Saturday groups (or one group per day or room
+# with partition_papers_kway).
 #
 # Partitioning is done to minimize the number of overall conflicts, based on PC
 # partitioning results.
 #
 # Note: this should be done after all the new conflicts we found are updated.
 
+import csv as bytecsv
+from itertools import izip_longest
 import random
 import unicodecsv as csv
+import numpy as np
+
+import base
+import partitionpc
+
+# Cost of putting a paper on a day one of its PC authors attends.
+FORBIDDEN_DAY_COST = 10**6
 
 def flip(prob):
   return random.random() < prob
 
-def compute_combined_score(papers, pc):
-  """ Compute the total number of conflicts for each day. """
+def compute_combined_score(papers, pc_ids):
+  """ Compute the total number of conflicts for each day.
+
+  pc_ids is the day's membership, the set of ids of its PC members (see
+  partitionpc.member_ids).
+  """
   total_conflicts = 0
   for paper in papers:
     for c in paper.pc_conflicts:
-      if c in pc:
+      if c.id in pc_ids:
         total_conflicts += 1
   return total_conflicts
 
-def partition_papers_once(friday_pc, saturday_pc, paperdb):
-  """ Create one partitioning of papers. """
-  friday_papers = []
-  saturday_papers = []
-  num_papers = len(paperdb.orig)
-  for paper in paperdb:
+def partition_papers_once(day_ids, papers):
+  """ Create one partitioning of papers into Friday (0) and Saturday (1).
+
+  Returns the day of each paper as an array.
+  """
+  friday_ids = day_ids[0]
+  assignment = np.zeros(len(papers), dtype=np.int64)
+  for i, paper in enumerate(papers):
     # If a paper's authors contains a PC member, add the paper to the opposite
     # day.
     is_pc_paper = False
     for author in paper.authors:
       if author.is_pc and not author.is_epc:
         is_pc_paper = True
-        if author in friday_pc:
-          saturday_papers.append(paper)
-        else:
-          friday_papers.append(paper)
+        if author.id in friday_ids:
+          assignment[i] = 1
         break
 
     # Otherwise, add it to any day with 1/2 probability.
-    if not is_pc_paper:
-      if flip(0.5):
-        friday_papers.append(paper)
-      else:
-        saturday_papers.append(paper)
+    if not is_pc_paper and not flip(0.5):
+      assignment[i] = 1
+
+  return assignment
+
+def partition_papers_kway_once(day_ids, papers):
+  """ Create one partitioning of papers into len(day_ids) days.
 
+  Returns the day of each paper as an array.
+  """
+  num_days = len(day_ids)
+  assignment = np.zeros(len(papers), dtype=np.int64)
+  for i, paper in enumerate(papers):
+    # If a paper's authors contains a PC member, add the paper to a day the
+    # author does not attend.
+    days = range(num_days)
+    for author in paper.authors:
+      if author.is_pc and not author.is_epc:
+        absent = [d for d in days if author.id not in day_ids[d]]
+        if absent:
+          days = absent
+        break
+    assignment[i] = random.choice(days)
+
+  return assignment
 
-  return friday_papers, saturday_papers
+def paper_partition_trials(args, search):
+  """ Run trials of a partitioning function, keeping the best in search.
 
-def partition_papers(friday_pc, saturday_pc, paperdb):
+  The score of a trial is a single lookup and sum over the papers x days
+  conflict counts.
+  """
+  partition_once, day_ids, papers, counts = args
+  rows = np.arange(len(papers))
+  while search.running():
+    assignment = partition_once(day_ids, papers)
+    total_score = int(counts[rows, assignment].sum())
+    if search.record(total_score):
+      search.best = assignment
+
+def partition_papers_kway(pc_groups, paperdb, jobs=1, seed=None, trials=100,
+                          time_limit=None, target=None, checkpoint=None,
+                          partition_once=partition_papers_kway_once,
+                          checkpoint_interval=300):
+  """ Randomly partition papers into one group per PC group.
+
+  Trials are spread over jobs processes, each seeded from seed. The search
+  stops early after time_limit seconds or once the number of conflicts
+  reaches target, and saves its progress to checkpoint (if given) every
+  checkpoint_interval seconds.
+  """
+  day_ids = [partitionpc.member_ids(group) for group in pc_groups]
+  papers, counts = day_conflict_counts(pc_groups, paperdb)
+  min_score, assignment = base.run_trials(
+      paper_partition_trials, (partition_once, day_ids, papers, counts),
+      trials, jobs, seed, budget=time_limit, target=target,
+      checkpoint=checkpoint, checkpoint_interval=checkpoint_interval)
+  return [[papers[i] for i in np.flatnonzero(assignment == day)]
+          for day in range(len(pc_groups))]
+
+def partition_papers(friday_pc, saturday_pc, paperdb, jobs=1, seed=None,
+                     trials=100, time_limit=None, target=None, checkpoint=None,
+                     checkpoint_interval=300):
   """ Randomly partition papers into Friday/Saturday groups. """
-  X = 100  # num trials.
-
-  min_score = 10000
-  best_partition = ()
-  for i in range(X):
-    friday_papers, saturday_papers = partition_papers_once(
-        friday_pc, saturday_pc, paperdb)
-    friday_score = compute_combined_score(friday_papers, friday_pc)
-    saturday_score = compute_combined_score(saturday_papers, saturday_pc)
-    total_score = friday_score + saturday_score
-    if total_score < min_score:
-      min_score = total_score
-      best_partition = (friday_papers, saturday_papers)
-      print min_score
-
-  return best_partition
+  return tuple(partition_papers_kway(
+      [friday_pc, saturday_pc], paperdb, jobs, seed, trials, time_limit,
+      target, checkpoint, partition_once=partition_papers_once,
+      checkpoint_interval=checkpoint_interval))
+
+def conflict_matrix(papers, members):
+  """ Build the papers x members 0/1 matrix of conflicts.
+
+  Returns a dict from member id to column and the matrix. Conflicts with
+  anyone outside members are left out.
+  """
+  member_index = {}
+  for member in members:
+    member_index.setdefault(member.id, len(member_index))
+  rows = []
+  cols = []
+  for i, paper in enumerate(papers):
+    for member in paper.pc_conflicts:
+      if member.id in member_index:
+        rows.append(i)
+        cols.append(member_index[member.id])
+  matrix = np.zeros((len(papers), len(member_index)), dtype=np.int64)
+  matrix[rows, cols] = 1
+  return member_index, matrix
+
+def day_conflict_counts(pc_groups, paperdb):
+  """ Count each paper's conflicted PC members present on each day.
+
+  Returns the papers and the papers x days matrix of counts.
+  """
+  papers = [paper for paper in paperdb]
+  members = [member for group in pc_groups for member in group]
+  member_index, conflicts = conflict_matrix(papers, members)
+  presence = np.zeros((len(member_index), len(pc_groups)), dtype=np.int64)
+  for day, group in enumerate(pc_groups):
+    presence[[member_index[member.id] for member in group], day] = 1
+  return papers, conflicts.dot(presence)
+
+def forbidden_days(day_ids, papers):
+  """ Mark the days attended by each paper's PC author (papers x days).
+
+  A paper whose PC author attends every day has no forbidden days.
+  """
+  forbidden = np.zeros((len(papers), len(day_ids)), dtype=bool)
+  for i, paper in enumerate(papers):
+    for author in paper.authors:
+      if author.is_pc and not author.is_epc:
+        attends = [author.id in ids for ids in day_ids]
+        if not all(attends):
+          forbidden[i] = attends
+        break
+  return forbidden
+
+def optimize_paper_partition(pc_groups, paperdb, max_imbalance=0.1):
+  """ Deterministically assign papers to days with the fewest conflicts.
+
+  Every day gets within max_imbalance (a fraction) of an equal share of the
+  papers. Papers start on their cheapest day and are moved off overfull
+  days by smallest regret. Then single moves and pairwise exchanges between
+  days are applied while they reduce the number of conflicts. For two days
+  the result is optimal.
+
+  Returns the list of paper groups and the number of conflicts.
+  """
+  papers, costs = day_conflict_counts(pc_groups, paperdb)
+  day_ids = [partitionpc.member_ids(group) for group in pc_groups]
+  costs = costs + FORBIDDEN_DAY_COST * forbidden_days(day_ids, papers)
+  num_papers, num_days = costs.shape
+  share = num_papers / float(num_days)
+  lo = min(int(np.floor(share * (1 - max_imbalance))), num_papers // num_days)
+  hi = max(int(np.ceil(share * (1 + max_imbalance))),
+           -(-num_papers // num_days))
+
+  # Greedy start, then empty overfull days and fill underfull ones.
+  assignment = np.argmin(costs, axis=1)
+  sizes = np.bincount(assignment, minlength=num_days)
+  while sizes.max() > hi or sizes.min() < lo:
+    if sizes.max() > hi:
+      src = np.flatnonzero(assignment == np.argmax(sizes))
+      targets = np.flatnonzero(sizes < hi)
+    else:
+      src = np.flatnonzero(sizes[assignment] > lo)
+      targets = np.array([np.argmin(sizes)])
+    regret = costs[src][:, targets] - costs[src, assignment[src]][:, np.newaxis]
+    i, t = np.unravel_index(np.argmin(regret), regret.shape)
+    sizes[assignment[src[i]]] -= 1
+    assignment[src[i]] = targets[t]
+    sizes[targets[t]] += 1
+
+  improved = True
+  while improved:
+    improved = False
+    for a in range(num_days):
+      for b in range(num_days):
+        if a == b:
+          continue
+        in_a = np.flatnonzero(assignment == a)
+        in_b = np.flatnonzero(assignment == b)
+        if len(in_a) == 0:
+          continue
+        move_a = costs[in_a, b] - costs[in_a, a]
+        i = np.argmin(move_a)
+        if move_a[i] < 0 and sizes[a] > lo and sizes[b] < hi:
+          assignment[in_a[i]] = b
+          sizes[a] -= 1
+          sizes[b] += 1
+          improved = True
+          continue
+        if a > b or len(in_b) == 0:
+          continue
+        move_b = costs[in_b, a] - costs[in_b, b]
+        j = np.argmin(move_b)
+        if move_a[i] + move_b[j] < 0:
+          assignment[in_a[i]] = b
+          assignment[in_b[j]] = a
+          improved = True
+
+  paper_groups = [[papers[i] for i in np.flatnonzero(assignment == day)]
+                  for day in range(num_days)]
+  score = int(costs[np.arange(num_papers), assignment].sum())
+  return paper_groups, score
 
 def import_paper_partition(fname, paperdb):
   """ Import a previously generated paper partition. """
@@ -79,162 +251,192 @@ def import_paper_partition(fname, paperdb):
       group.append(paper)
   return group
 
+def paper_partition_lines(papergroup):
+  """ Generate the "<id>: <title>" lines of a paper list, UTF-8 encoded. """
+  for paper in papergroup:
+    yield "%d: %s\n" % (paper.id, paper.title.encode("utf-8"))
+
 def export_paper_partition(papergroup, label):
   """ Export the list of papers in this group. """
   with open("%s_papers.txt" % label, "wb") as f:
-    for paper in papergroup:
-      f.write("%d: " % paper.id + paper.title.encode("utf-8") + "\n")
-
-def export_paper_spreadsheet(papergroup, pcgroup, label):
-  """ Export a spreadsheet of papers and PC members per group. """
-  with open("%s_papers.csv" % label, "wb") as f:
-    header = [str(paper.id) for paper in papergroup]
-    f.write(",")
-    f.write(",".join(header))
-    f.write("\n")
-    for member in pcgroup:
-      line = member.name + ","
-      for paper in papergroup:
-        if member in paper.pc_conflicts:
-          line += "C,"
-        else:
-          line += ","
-      f.write(line.encode("utf-8") + "\n")
+    f.writelines(paper_partition_lines(papergroup))
+
+def conflicts_by_member(papergroup):
+  """ Map each PC member id to the columns of the papers it conflicts with. """
+  columns = {}
+  for col, paper in enumerate(papergroup):
+    for member in paper.pc_conflicts:
+      columns.setdefault(member.id, []).append(col)
+  return columns
+
+def paper_spreadsheet_header(papergroup):
+  """ The header line of the paper spreadsheet: an empty cell, then paper ids.
+
+  Written as a line rather than a csv row, since the csv module would write
+  the lone empty cell of a group without papers as "".
+  """
+  return "," + ",".join(str(paper.id) for paper in papergroup) + "\n"
+
+def paper_spreadsheet_rows(papergroup, pcgroup):
+  """ Generate the member rows of the paper spreadsheet.
+
+  Each member row starts from a row of empty cells and only fills in the
+  member's conflicts, so the work is proportional to the size of the sheet
+  plus the number of conflicts. Cells are UTF-8 encoded byte strings.
+  """
+  columns = conflicts_by_member(papergroup)
+  empty = [""] * len(papergroup)
+  for member in pcgroup:
+    row = [member.name.encode("utf-8")] + empty + [""]
+    for col in columns.get(member.id, ()):
+      row[1 + col] = "C"
+    yield row
+
+PAPER_SPREADSHEET_LONG_HEADER = "paper,pc,flag\n"
+
+def paper_spreadsheet_long_rows(papergroup, pcgroup):
+  """ Generate the (paper, pc, flag) rows of the long format.
+
+  Cells are UTF-8 encoded byte strings.
+  """
+  ids = partitionpc.member_ids(pcgroup)
+  for paper in papergroup:
+    for member in sorted(paper.pc_conflicts):
+      if member.id in ids:
+        yield [paper.id, member.name.encode("utf-8"), "C"]
+
+def export_paper_spreadsheet(papergroup, pcgroup, label, long_format=False):
+  """ Export a spreadsheet of papers and PC members per group.
+
+  With long_format, write one (paper, pc, flag) row per conflict to
+  <label>_papers_long.csv instead, for groups too wide for spreadsheets.
+  """
+  if long_format:
+    fname = "%s_papers_long.csv" % label
+    header = PAPER_SPREADSHEET_LONG_HEADER
+    rows = paper_spreadsheet_long_rows(papergroup, pcgroup)
+  else:
+    fname = "%s_papers.csv" % label
+    header = paper_spreadsheet_header(papergroup)
+    rows = paper_spreadsheet_rows(papergroup, pcgroup)
+  # Rows are already encoded, and the standard csv module writes them much
+  # faster than unicodecsv.
+  with open(fname, "wb") as f:
+    f.write(header)
+    writer = bytecsv.writer(f, delimiter=",", lineterminator="\n")
+    writer.writerows(rows)
 
 def merge_paper_spreadsheets(old_sheet_fname, new_sheet_fname, label):
   """ Take two paper spreadsheets and merge them into one.
 
   They should have the same dimensions. Cells with multiple data will be
-  labeled as such.
+  labeled as such. Both sheets are read one row at a time, in lockstep.
   """
-  old_sheet = []
-  new_sheet = []
-  old_sheet_header = []
-  new_sheet_header = []
-  with open(old_sheet_fname, "r") as f:
-    reader = csv.reader(f, delimiter=",")
-    old_sheet_header = next(reader, None)
-    for row in reader:
-      old_sheet.append(row)
+  with open(old_sheet_fname, "r") as old_f, \
+       open(new_sheet_fname, "r") as new_f, \
+       open("%s_merged_papers.csv" % label, "wb") as out_f:
+    old_reader = csv.reader(old_f, delimiter=",")
+    new_reader = csv.reader(new_f, delimiter=",")
+    writer = csv.writer(out_f, delimiter=",")
+    old_sheet_header = next(old_reader, None)
+    new_sheet_header = next(new_reader, None)
+
+    # List of papers must be the same.
+    assert(old_sheet_header == new_sheet_header)
+    num_columns = len(old_sheet_header)
+    writer.writerow(old_sheet_header)
 
-  with open(new_sheet_fname, "r") as f:
-    reader = csv.reader(f, delimiter=",")
-    new_sheet_header = next(reader, None)
-    for row in reader:
-      new_sheet.append(row)
-
-  # List of papers must be the same.
-  assert(old_sheet_header == new_sheet_header)
-  assert(len(old_sheet) == len(new_sheet))
-  num_columns = len(old_sheet_header)
-  num_rows = len(old_sheet)
-
-  merged_sheet = []
-  for row in range(num_rows):
-    merged_row = []
-    # Verify first column names.
-    assert(old_sheet[row][0] == new_sheet[row][0])
-    merged_row.append(old_sheet[row][0])
-    for col in range(1, num_columns):
-      old_val = old_sheet[row][col]
-      new_val = new_sheet[row][col]
-      if old_val.upper() == "C" or old_val.upper() == "":
-        # If old value was a conflict or empty, ignore it and use the new
-        # value.
-        merged_row.append(new_val)
-      else:
-        # We had something else here, like a preference score.
-        if new_val.upper() == "C":
-          # If the new value was a conflict, then mark this as problematic.
-          merged_row.append("X (%s)" % old_val)
+    for old_row, new_row in izip_longest(old_reader, new_reader):
+      assert(old_row is not None and new_row is not None)
+      # Verify first column names.
+      assert(old_row[0] == new_row[0])
+      merged_row = [old_row[0]]
+      for col in range(1, num_columns):
+        old_val = old_row[col]
+        new_val = new_row[col]
+        if old_val.upper() == "C" or old_val.upper() == "":
+          # If old value was a conflict or empty, ignore it and use the new
+          # value.
+          merged_row.append(new_val)
         else:
-          # Otherwise, use the old value.
-          merged_row.append(old_val)
-
-    merged_sheet.append(merged_row)
+          # We had something else here, like a preference score.
+          if new_val.upper() == "C":
+            # If the new value was a conflict, then mark this as problematic.
+            merged_row.append("X (%s)" % old_val)
+          else:
+            # Otherwise, use the old value.
+            merged_row.append(old_val)
 
-  # Merging is done. Write the output.
-  with open("%s_merged_papers.csv" % label, "wb") as f:
-    writer = csv.writer(f, delimiter=",")
-    writer.writerow(old_sheet_header)
-    for row in merged_sheet:
-      writer.writerow(row)
+      writer.writerow(merged_row)
 
 def merge_assignments_with_spreadsheet(
     assignments_fname, spreadsheet_fname, outfname, pcdb):
   """ Merge a conflicts+preferences spreadsheet with assignments.
 
   The assigned reviewers+PCs will have SELECTED (X) in their cells,
-  where X was the original value of the cell.
+  where X was the original value of the cell. The spreadsheet is merged one
+  row at a time.
   """
-  assignments = []
-  spreadsheet = []
-  with open(assignments_fname, "r") as f:
-    reader = csv.reader(f, delimiter=",")
-    for row in reader:
-      assignments.append(row)
+  members_by_email = dict((member.email, member) for member in pcdb)
+  members_by_name = dict((member.name, member) for member in pcdb)
+  for member in pcdb:
+    member.assignments = set()
 
-  papers = []
-  with open(spreadsheet_fname, "r") as f:
+  with open(assignments_fname, "r") as f:
     reader = csv.reader(f, delimiter=",")
-    papers = reader.next()
+    next(reader, None)  # Skip the header.
     for row in reader:
-      spreadsheet.append(row)
-  num_columns = len(papers)
+      paperid = int(row[0])
+      email = row[2]
+      members_by_email[email].assignments.add(paperid)
 
-  for row in assignments[1:]:
-    paperid = int(row[0])
-    email = row[2]
-    pcmember = pcdb[pcdb.getid(email, field="email")]
-    pcmember.assignments.append(paperid)
-
-  merged_sheet = []
   distribution = dict((i, 0) for i in range(1, 11))
   distribution["None"] = 0
 
   per_pc_member = {}
-  for row in range(len(spreadsheet)):
-    merged_row = []
-    pcname = spreadsheet[row][0]
-    if pcname == "":
-      continue
-    pcmember = pcdb[pcdb.getid(pcname)]
-    merged_row.append(pcname)
-    for col in range(3, num_columns):
-      paperid = int(papers[col])
-      old_val = spreadsheet[row][col]
-      if old_val.upper() == "C":
-        # If old value was a conflict, keep it.
-        merged_row.append(old_val)
-      else:
-        # If there was either nothing here, or a score preference, AND this
-        # pcmember was selected to review this paper, then mark it as such.
-        if paperid in pcmember.assignments:
-          new_val = "SELECTED (%s)" % old_val
-
-          pcpref = spreadsheet[row][col]
-          try:
-            pcpref = int(pcpref)
-            distribution[pcpref] += 1
-          except ValueError as e:
-            distribution["None"] += 1
-
-          if pcmember.name in per_pc_member:
-            per_pc_member[pcmember.name] += 1
-          else:
-            per_pc_member[pcmember.name] = 1
+  with open(spreadsheet_fname, "r") as f, open(outfname, "w") as out_f:
+    reader = csv.reader(f, delimiter=",")
+    writer = csv.writer(out_f, delimiter=",")
+    papers = reader.next()
+    num_columns = len(papers)
+    paperids = [None] * 3 + [int(pid) for pid in papers[3:]]
+    writer.writerow(papers[2:])
 
+    for row in reader:
+      pcname = row[0]
+      if pcname == "":
+        continue
+      pcmember = members_by_name[pcname]
+      merged_row = [pcname]
+      for col in range(3, num_columns):
+        paperid = paperids[col]
+        old_val = row[col]
+        if old_val.upper() == "C":
+          # If old value was a conflict, keep it.
+          merged_row.append(old_val)
         else:
-          new_val = old_val
-        merged_row.append(new_val)
+          # If there was either nothing here, or a score preference, AND this
+          # pcmember was selected to review this paper, then mark it as such.
+          if paperid in pcmember.assignments:
+            new_val = "SELECTED (%s)" % old_val
+
+            pcpref = row[col]
+            try:
+              pcpref = int(pcpref)
+              distribution[pcpref] += 1
+            except ValueError as e:
+              distribution["None"] += 1
+
+            if pcmember.name in per_pc_member:
+              per_pc_member[pcmember.name] += 1
+            else:
+              per_pc_member[pcmember.name] = 1
 
-    merged_sheet.append(merged_row)
+          else:
+            new_val = old_val
+          merged_row.append(new_val)
 
-  with open(outfname, "w") as f:
-    writer = csv.writer(f, delimiter=",")
-    writer.writerow(papers[2:])
-    for row in merged_sheet:
-      writer.writerow(row)
+      writer.writerow(merged_row)
 
   print "Assignments by preference score."
   for key, val in distribution.iteritems():
@@ -1,17 +1,34 @@
 # Partition the PC into Friday and Saturday Groups.
 #
-# Strategies: random and smart.
+# Strategies: random, smart, exact and anneal.
+#
+# With storage_saturday, Either and Both members with a storage topic are
+# never placed on Friday alone. Every strategy and verify_allowed_days apply
+# the same rule (allowed_days), so their scores can be compared. The smart
+# merge also leans towards Saturday when it samples a storage topic, but
+# that is a heuristic, not a constraint.
+#
+# partition_pc_kway generalizes this to K meeting days or parallel rooms.
 
+from bisect import bisect_left, insort
 import random
 import re
+import time
 import unicodecsv as csv
 import numpy as np
 
+import base
+
 FRIDAY_TAG = "PC_Friday"
 SATURDAY_TAG = "PC_Saturday"
 BOTH_TAG = "PC_Both"
 EITHER_TAG = "PC_Either"
 
+# Tags for K-way partitions. Days are numbered from 1.
+DAY_TAG = "PC_Day%d"
+ANY_TAG = "PC_Any"
+ALL_TAG = "PC_All"
+
 def count_topics(group):
   """ Produce the distribution of topics from this group of PC members. """
   topics_by_pc = {}
@@ -30,28 +47,60 @@ def normalize_topic_distribution(dist, total):
     normalized[topic] = 100.0 * dist[topic] / total[topic]
   return normalized
 
-def compute_combined_score(friday, saturday, total):
+class TopicMatrix(object):
+  """ PC topics encoded as a members x topics 0/1 matrix.
+
+  Rows follow the iteration order of the PC database and columns the sorted
+  topic names. The topic counts of a group of members are the product of the
+  group's membership vector with this matrix.
+  """
+
+  def __init__(self, pcdb):
+    self.topics = sorted(count_topics(pcdb))
+    self.topic_index = dict((t, i) for i, t in enumerate(self.topics))
+    members = [member for member in pcdb]
+    self.row_index = dict((member.id, i) for i, member in enumerate(members))
+    self.matrix = np.zeros((len(members), len(self.topics)), dtype=np.int64)
+    for i, member in enumerate(members):
+      for topic in member.topics:
+        self.matrix[i, self.topic_index[topic]] = 1
+
+  def row(self, member):
+    """ The topic vector of a single member. """
+    return self.matrix[self.row_index[member.id]]
+
+  def membership(self, group):
+    """ The membership vector of a group (members may appear twice). """
+    x = np.zeros(len(self.row_index), dtype=np.int64)
+    for member in group:
+      x[self.row_index[member.id]] += 1
+    return x
+
+  def counts(self, group):
+    """ Number of members of group declaring each topic. """
+    return self.membership(group).dot(self.matrix)
+
+def compute_combined_score(friday, saturday, topic_matrix):
   """ Compute score based on both groups simultaneously.
 
   Score is equal to the sum of the absolute value of differences.
   """
-  friday_topics = count_topics(friday)
-  saturday_topics = count_topics(saturday)
-  score = 0
-  for topic in friday_topics.iterkeys():
-    diff = abs(friday_topics[topic] - saturday_topics[topic])
-    score += diff
-  return score
+  diff = topic_matrix.counts(friday) - topic_matrix.counts(saturday)
+  return int(np.abs(diff).sum())
 
-def compute_interday_diff(friday, saturday):
-  friday_topics = count_topics(friday)
-  saturday_topics = count_topics(saturday)
-  diff = [(friday_topics[t] - saturday_topics[t], t) for t in friday_topics.iterkeys()]
-  diff.sort(key=lambda v:v[0], reverse=True)
-  sorted_diffs = [k[0] for k in diff]
-  sorted_percents = np.abs(np.array(sorted_diffs).astype(float))
+def compute_interday_diff(friday_counts, saturday_counts, topic_matrix):
+  """ Sort the topics by the difference in counts between the two days.
+
+  Returns the sorted topic names, the sorted differences and each
+  difference's share of the total absolute difference. Ties keep the topic
+  order of topic_matrix.
+  """
+  diff = friday_counts - saturday_counts
+  order = np.argsort(-diff, kind="mergesort")
+  sorted_diffs = diff[order]
+  sorted_percents = np.abs(sorted_diffs).astype(float)
   sorted_percents = sorted_percents / np.sum(sorted_percents)
-  sorted_names = [k[1] for k in diff]
+  sorted_names = [topic_matrix.topics[i] for i in order]
   return sorted_names, sorted_percents, sorted_diffs
 
 def compute_distribution_score(group, total):
@@ -75,11 +124,12 @@ def compute_distribution_score(group, total):
 def flip(prob):
   return random.random() < prob
 
-def merge_groups_random(friday, saturday, either, both):
+def merge_groups_random(friday, saturday, either, both,
+                        storage_saturday=False):
   # Members of either go into one of the other with probability 1/2.
   coinflips = [flip(0.5) for i in range(len(either))]
   for i, coinflip in enumerate(coinflips):
-    if i:
+    if i and not saturday_only(either[i], storage_saturday):
       friday.append(either[i])
     else:
       saturday.append(either[i])
@@ -91,35 +141,48 @@ def merge_groups_random(friday, saturday, either, both):
       friday.append(member)
       saturday.append(member)
     else:
-      if flip(1-prob):
+      if flip(1-prob) and not saturday_only(member, storage_saturday):
         friday.append(member)
       else:
         saturday.append(member)
 
   return friday, saturday
 
-def find_best_merging_random(friday, saturday, either, both, total_topics):
-  """ Merge either and both into friday or saturday.
+def members_by_id(groups):
+  """ Map member ids back to the members of the given groups. """
+  return dict((member.id, member) for group in groups for member in group)
 
-  Either can only go into one or the other. Both could go into both. The decisions
-  are based on straight probabilities of uniformly distributed random numbers.
-  """
-  X = 100000
-  min_score = 10000000
-  best_dist = ()
-  for i in range(X):
+def random_merging_trials(args, search):
+  """ Run trials of merge_groups_random, keeping the best ids in search. """
+  friday, saturday, either, both, topic_matrix, storage_saturday = args
+  while search.running():
     # Merge groups X times and find the best distribution.
     merged_friday = [e for e in friday]
     merged_saturday = [e for e in saturday]
 
-    merge_groups_random(merged_friday, merged_saturday, either, both)
-    total_score = compute_combined_score(merged_friday, merged_saturday, total_topics)
-    if total_score <= min_score:
-      min_score = total_score
-      best_dist = (merged_friday, merged_saturday)
-      print min_score
+    merge_groups_random(merged_friday, merged_saturday, either, both,
+                        storage_saturday)
+    total_score = compute_combined_score(
+        merged_friday, merged_saturday, topic_matrix)
+    if search.record(total_score):
+      search.best = ([m.id for m in merged_friday],
+                     [m.id for m in merged_saturday])
+
+def find_best_merging_random(friday, saturday, either, both, topic_matrix,
+                             storage_saturday=False, jobs=1, seed=None,
+                             **search_options):
+  """ Merge either and both into friday or saturday.
 
-  return best_dist
+  Either can only go into one or the other. Both could go into both. The decisions
+  are based on straight probabilities of uniformly distributed random numbers.
+  """
+  X = 100000
+  min_score, best_ids = base.run_trials(
+      random_merging_trials,
+      (friday, saturday, either, both, topic_matrix, storage_saturday),
+      X, jobs, seed, ties=True, **search_options)
+  lookup = members_by_id((friday, saturday, either, both))
+  return tuple([lookup[i] for i in ids] for ids in best_ids)
 
 def get_random_qualifying_pc_member(group, topic):
   qualifying_pc_members = [member for member in group
@@ -128,7 +191,61 @@ def get_random_qualifying_pc_member(group, topic):
     return None
   return np.random.choice(qualifying_pc_members)
 
-def merge_groups_smart(friday, saturday, either, both):
+class InterdayDiff(object):
+  """ Friday minus Saturday topic counts, sorted as compute_interday_diff does.
+
+  With incremental set, the difference vector and its sort order are updated
+  in place from the topic vector of each member that is placed, touching only
+  that member's topics. Otherwise the counts of both days are kept and the
+  difference is recomputed from scratch on every call to sorted().
+  """
+
+  def __init__(self, friday, saturday, topic_matrix, incremental=True):
+    self.topic_matrix = topic_matrix
+    self.incremental = incremental
+    self.friday_counts = topic_matrix.counts(friday)
+    self.saturday_counts = topic_matrix.counts(saturday)
+    self.diff = self.friday_counts - self.saturday_counts
+    # Sort keys are (-diff, topic index), which is the order of a stable sort
+    # by decreasing difference.
+    self.keys = sorted((-int(d), t) for t, d in enumerate(self.diff))
+    self.abs_total = int(np.abs(self.diff).sum())
+
+  def add(self, member, on_friday, on_saturday):
+    """ Account for member being placed on one or both days. """
+    row = self.topic_matrix.row(member)
+    if not self.incremental:
+      if on_friday:
+        self.friday_counts += row
+      if on_saturday:
+        self.saturday_counts += row
+      return
+
+    change = int(on_friday) - int(on_saturday)
+    if change == 0:
+      return
+    for t in np.flatnonzero(row):
+      old = int(self.diff[t])
+      new = old + change
+      del self.keys[bisect_left(self.keys, (-old, t))]
+      insort(self.keys, (-new, t))
+      self.diff[t] = new
+      self.abs_total += abs(new) - abs(old)
+
+  def sorted(self):
+    """ Return the sorted topic names, percents and differences. """
+    if not self.incremental:
+      return compute_interday_diff(
+          self.friday_counts, self.saturday_counts, self.topic_matrix)
+    order = [k[1] for k in self.keys]
+    sorted_diffs = self.diff[order]
+    sorted_percents = np.abs(sorted_diffs).astype(float)
+    sorted_percents = sorted_percents / np.float64(self.abs_total)
+    sorted_names = [self.topic_matrix.topics[i] for i in order]
+    return sorted_names, sorted_percents, sorted_diffs
+
+def merge_groups_smart(friday, saturday, either, both, topic_matrix,
+                       incremental=True, storage_saturday=False):
   """ Smart(er) merging strategy.
 
   While we still have PC members in 'either' or 'both':
@@ -140,8 +257,13 @@ def merge_groups_smart(friday, saturday, either, both):
     - Randomly select a PC member from this list.
     - If the difference is negative, add it to Friday; otherwise, add it to Saturday
 
+  The sorted topic differences are maintained by InterdayDiff. Pass
+  incremental=False to recompute them from scratch after every placement.
+  With storage_saturday, members that allowed_days keeps off Friday go to
+  Saturday instead.
   """
-  names, percents, diffs= compute_interday_diff(friday, saturday)
+  interday = InterdayDiff(friday, saturday, topic_matrix, incremental)
+  names, percents, diffs = interday.sorted()
   while len(either) > 0 or len(both) > 0:
     # Using this difference as a distribution, draw a random number.
     p = np.random.choice(np.arange(len(diffs)), p=percents)
@@ -172,10 +294,12 @@ def merge_groups_smart(friday, saturday, either, both):
           # to groups at random, preferring the shorter list.
           for member in either:
             prob = len(friday)/float(len(friday) + len(saturday))
-            if flip(1-prob):
+            if flip(1-prob) and not saturday_only(member, storage_saturday):
               friday.append(member)
+              interday.add(member, True, False)
             else:
               saturday.append(member)
+              interday.add(member, False, True)
           either = []
         else:
           # Redistribute probability of removed topic among the rest.
@@ -185,7 +309,10 @@ def merge_groups_smart(friday, saturday, either, both):
           continue
       else:
         # Based on sign of the difference, put into the appropriate list.
+        if saturday_only(selection, storage_saturday):
+          dest = saturday
         dest.append(selection)
+        interday.add(selection, dest is friday, dest is saturday)
         either.remove(selection)
     elif len(both) > 0:
       # For members in both, add them to both days with some probability.
@@ -208,21 +335,21 @@ def merge_groups_smart(friday, saturday, either, both):
       if flip(0.4):
         friday.append(selection)
         saturday.append(selection)
+        interday.add(selection, True, True)
       else:
+        if saturday_only(selection, storage_saturday):
+          dest = saturday
         dest.append(selection)
+        interday.add(selection, dest is friday, dest is saturday)
       both.remove(selection)
-    names, percents, diffs = compute_interday_diff(friday, saturday)
+    names, percents, diffs = interday.sorted()
 
   return friday, saturday
 
-def find_best_merging_smart(friday, saturday, either, both, total_topics):
-  """ Actively try to bring distributions into balance. """
-  num_topics = len(total_topics)
-
-  min_score = 10000
-  X = 10000  # Num of trials
-  best_dist = ()
-  for i in range(X):
+def smart_merging_trials(args, search):
+  """ Run trials of merge_groups_smart, keeping the best ids in search. """
+  friday, saturday, either, both, topic_matrix, storage_saturday = args
+  while search.running():
     # Make a copy of all arrays.
     merged_friday = [e for e in friday]
     merged_saturday = [e for e in saturday]
@@ -230,24 +357,35 @@ def find_best_merging_smart(friday, saturday, either, both, total_topics):
     temp_either = [e for e in either]
 
     merged_friday, merged_saturday = merge_groups_smart(
-        merged_friday, merged_saturday, temp_either, temp_both)
-    score = compute_combined_score(merged_friday, merged_saturday, total_topics)
-    if score < min_score:
-      min_score = score
-      best_dist = (merged_friday, merged_saturday)
-      print min_score
-
-  return best_dist
-
-def partition_pc(pcdb, strategy="random"):
-  """ Partition the PC into Friday and Saturday groups. """
+        merged_friday, merged_saturday, temp_either, temp_both, topic_matrix,
+        storage_saturday=storage_saturday)
+    score = compute_combined_score(merged_friday, merged_saturday, topic_matrix)
+    if search.record(score):
+      search.best = ([m.id for m in merged_friday],
+                     [m.id for m in merged_saturday])
+
+def find_best_merging_smart(friday, saturday, either, both, topic_matrix,
+                            storage_saturday=False, jobs=1, seed=None,
+                            **search_options):
+  """ Actively try to bring distributions into balance. """
+  X = 10000  # Num of trials
+  min_score, best_ids = base.run_trials(
+      smart_merging_trials,
+      (friday, saturday, either, both, topic_matrix, storage_saturday),
+      X, jobs, seed, **search_options)
+  lookup = members_by_id((friday, saturday, either, both))
+  return tuple([lookup[i] for i in ids] for ids in best_ids)
+
+def member_ids(group):
+  """ The membership of a group, as a frozenset of member ids. """
+  return frozenset(member.id for member in group)
+
+def split_by_tag(pcdb):
+  """ Split the PC into Friday, Saturday, Either and Both lists by tag. """
   friday = []
   saturday = []
   either = []
   both = []
-
-  total_topics = count_topics(pcdb)
-
   for member in pcdb:
     if FRIDAY_TAG in member.tags:
       friday.append(member)
@@ -257,16 +395,429 @@ def partition_pc(pcdb, strategy="random"):
       either.append(member)
     elif BOTH_TAG in member.tags:
       both.append(member)
+  return friday, saturday, either, both
+
+def is_storage_member(member):
+  """ True for members with a storage topic. """
+  return any(topic.upper().startswith("STORAGE") for topic in member.topics)
+
+def saturday_only(member, storage_saturday):
+  """ True if storage_saturday keeps this flexible member off Friday alone. """
+  return storage_saturday and is_storage_member(member)
+
+def allowed_days(member, storage_saturday=False):
+  """ List the (on_friday, on_saturday) choices open to a flexible member. """
+  choices = [(True, False), (False, True)]
+  if BOTH_TAG in member.tags:
+    choices.append((True, True))
+  if saturday_only(member, storage_saturday):
+    choices.remove((True, False))
+  return choices
+
+def compute_lower_bound(diff, remaining, remaining_fixed_sign):
+  """ Lower bound on the final score given the remaining flexible members.
+
+  Each remaining member can move the difference of a topic by at most one, so
+  topic t ends at least |diff[t]| - remaining[t] away from zero. When none of
+  the remaining members of a topic can attend both days, every one of them
+  changes the difference by exactly one and its parity is fixed.
+  """
+  bound = np.maximum(np.abs(diff) - remaining, 0)
+  parity = (np.abs(diff) + remaining) % 2
+  bound = np.where(remaining_fixed_sign, np.maximum(bound, parity), bound)
+  return int(bound.sum())
+
+def find_best_merging_exact(friday, saturday, either, both, topic_matrix,
+                            time_limit=600, storage_saturday=False):
+  """ Find the assignment of either and both with the minimum score.
+
+  Depth-first branch-and-bound over the day choices of each flexible member,
+  most topics first, pruned with compute_lower_bound. Returns the best
+  partition found, the score of that partition and a lower bound on the
+  optimal score. The two are equal if the search finished within time_limit
+  seconds.
+  """
+  flexible = either + both
+  choices = [allowed_days(member, storage_saturday) for member in flexible]
+  rows = np.array([topic_matrix.row(member) for member in flexible],
+                  dtype=np.int64).reshape(len(flexible), len(topic_matrix.topics))
+  order = np.argsort(-rows.sum(axis=1), kind="mergesort")
+  flexible = [flexible[i] for i in order]
+  choices = [choices[i] for i in order]
+  rows = rows[order]
+  changes = [[int(f) - int(s) for f, s in member_choices]
+             for member_choices in choices]
+  can_attend_both = np.array([0 in c for c in changes], dtype=np.int64)
+
+  # remaining[k] is the number of members k.. declaring each topic.
+  num_members = len(flexible)
+  remaining = np.zeros((num_members + 1, rows.shape[1]), dtype=np.int64)
+  remaining_both = np.zeros((num_members + 1, rows.shape[1]), dtype=np.int64)
+  for k in range(num_members - 1, -1, -1):
+    remaining[k] = remaining[k+1] + rows[k]
+    remaining_both[k] = remaining_both[k+1] + rows[k] * can_attend_both[k]
+  fixed_sign = remaining_both == 0
+
+  def bound(k, diff):
+    return compute_lower_bound(diff, remaining[k], fixed_sign[k])
+
+  base = topic_matrix.counts(friday) - topic_matrix.counts(saturday)
+
+  # Greedy incumbent: give each member the choice that helps most right now.
+  diff = base.copy()
+  best_picks = []
+  for k in range(num_members):
+    scores = [np.abs(diff + c * rows[k]).sum() for c in changes[k]]
+    pick = int(np.argmin(scores))
+    diff += changes[k][pick] * rows[k]
+    best_picks.append(pick)
+  min_score = int(np.abs(diff).sum())
+  print min_score
+
+  start = time.time()
+  stack = [(bound(0, base), 0, base, ())]
+  nodes = 0
+  while stack:
+    node_bound, k, diff, picks = stack.pop()
+    if node_bound >= min_score:
+      continue
+    if k == num_members:
+      min_score = int(np.abs(diff).sum())
+      best_picks = list(picks)
+      print min_score
+      continue
+
+    nodes += 1
+    if nodes % 1000 == 0 and time.time() - start > time_limit:
+      stack.append((node_bound, k, diff, picks))
+      break
+
+    children = []
+    for pick, change in enumerate(changes[k]):
+      child_diff = diff + change * rows[k]
+      child_bound = bound(k+1, child_diff)
+      if child_bound < min_score:
+        children.append((child_bound, k+1, child_diff, picks + (pick,)))
+    # Explore the most promising child first.
+    children.sort(key=lambda child: child[0], reverse=True)
+    stack.extend(children)
+
+  lower_bound = min([min_score] + [node[0] for node in stack])
+  if lower_bound == min_score:
+    print "Optimal score %d (%d nodes)" % (min_score, nodes)
+  else:
+    print "Best score %d, lower bound %d (%d nodes, time limit hit)" % (
+        min_score, lower_bound, nodes)
+
+  merged_friday = [e for e in friday]
+  merged_saturday = [e for e in saturday]
+  for member, member_choices, pick in zip(flexible, choices, best_picks):
+    on_friday, on_saturday = member_choices[pick]
+    if on_friday:
+      merged_friday.append(member)
+    if on_saturday:
+      merged_saturday.append(member)
+
+  return (merged_friday, merged_saturday), min_score, lower_bound
+
+def find_best_merging_anneal(friday, saturday, either, both, topic_matrix,
+                             iterations=100000, start_temp=3.0, end_temp=0.2,
+                             storage_saturday=False):
+  """ Improve a smart merge with simulated annealing.
+
+  Starting from one run of merge_groups_smart, repeatedly try one of these
+  moves on the flexible members:
+    - Move: put an Either or Both member on another of its allowed days.
+    - Swap: exchange the days of two Either members on different days.
+    - Toggle: move a Both member between both days and a single day.
+  The score change of a move only depends on the topics of the members it
+  touches. Improving moves are always taken, worse ones with a probability
+  that decreases with the temperature, which cools geometrically from
+  start_temp to end_temp. Members keep to allowed_days with the same
+  storage_saturday as the smart merge, so the annealing starts from the smart
+  merge unchanged and never ends worse than it.
+  """
+  start_friday, start_saturday = merge_groups_smart(
+      [e for e in friday], [e for e in saturday],
+      [e for e in either], [e for e in both], topic_matrix,
+      storage_saturday=storage_saturday)
+  seed_score = compute_combined_score(start_friday, start_saturday,
+                                      topic_matrix)
+  start_friday = set(m.id for m in start_friday)
+  start_saturday = set(m.id for m in start_saturday)
+
+  flexible = either + both
+  choices = [allowed_days(member, storage_saturday) for member in flexible]
+  changes = [[int(f) - int(s) for f, s in member_choices]
+             for member_choices in choices]
+  rows = [topic_matrix.row(member) for member in flexible]
+  topic_idx = [np.flatnonzero(row) for row in rows]
+  either_idx = range(len(either))
+  both_idx = range(len(either), len(flexible))
+
+  # Start from the smart merge.
+  picks = [member_choices.index((member.id in start_friday,
+                                 member.id in start_saturday))
+           for member, member_choices in zip(flexible, choices)]
+  diff = topic_matrix.counts(friday) - topic_matrix.counts(saturday)
+  for k, pick in enumerate(picks):
+    diff += changes[k][pick] * rows[k]
+
+  def move_delta(moves):
+    """ Score change and new diff entries for a list of (member, pick). """
+    idx = np.unique(np.concatenate([topic_idx[k] for k, pick in moves]))
+    new_diff = diff[idx].copy()
+    for k, pick in moves:
+      new_diff += (changes[k][pick] - changes[k][picks[k]]) * rows[k][idx]
+    return int(np.abs(new_diff).sum() - np.abs(diff[idx]).sum()), idx, new_diff
+
+  score = int(np.abs(diff).sum())
+  min_score = score
+  best_picks = list(picks)
+  print min_score
+  cooling = (end_temp / start_temp) ** (1.0 / max(iterations, 1))
+  temp = start_temp
+  # Without flexible members there is nothing to move.
+  for i in range(iterations if flexible else 0):
+    temp *= cooling
+    move_type = np.random.randint(3)
+    if move_type == 1 and len(either) > 1:
+      a, b = np.random.choice(either_idx, 2, replace=False)
+      if picks[a] == picks[b]:
+        continue
+      new_a = choices[a].index(choices[b][picks[b]]) \
+          if choices[b][picks[b]] in choices[a] else None
+      new_b = choices[b].index(choices[a][picks[a]]) \
+          if choices[a][picks[a]] in choices[b] else None
+      if new_a is None or new_b is None:
+        continue
+      moves = [(a, new_a), (b, new_b)]
+    elif move_type == 2 and len(both) > 0:
+      k = np.random.choice(both_idx)
+      both_pick = choices[k].index((True, True))
+      if picks[k] == both_pick:
+        singles = [p for p in range(len(choices[k])) if p != both_pick]
+        moves = [(k, np.random.choice(singles))]
+      else:
+        moves = [(k, both_pick)]
+    else:
+      k = np.random.randint(len(flexible))
+      if len(choices[k]) < 2:
+        continue
+      others = [p for p in range(len(choices[k])) if p != picks[k]]
+      moves = [(k, np.random.choice(others))]
+
+    delta, idx, new_diff = move_delta(moves)
+    if delta <= 0 or np.random.random() < np.exp(-delta / temp):
+      diff[idx] = new_diff
+      for k, pick in moves:
+        picks[k] = pick
+      score += delta
+      if score < min_score:
+        min_score = score
+        best_picks = list(picks)
+        print min_score
+
+  print "Annealing: seed score %d, refined score %d" % (seed_score, min_score)
+  if min_score > seed_score:
+    print "Refined score is worse than the seed's"
+
+  merged_friday = [e for e in friday]
+  merged_saturday = [e for e in saturday]
+  for member, member_choices, pick in zip(flexible, choices, best_picks):
+    on_friday, on_saturday = member_choices[pick]
+    if on_friday:
+      merged_friday.append(member)
+    if on_saturday:
+      merged_saturday.append(member)
+
+  return merged_friday, merged_saturday
+
+def anneal_merging_trials(args, search):
+  """ Run independent annealing runs, keeping the best ids in search. """
+  friday, saturday, either, both, topic_matrix, storage_saturday = args
+  while search.running():
+    merged_friday, merged_saturday = find_best_merging_anneal(
+        friday, saturday, either, both, topic_matrix,
+        storage_saturday=storage_saturday)
+    score = compute_combined_score(merged_friday, merged_saturday, topic_matrix)
+    if search.record(score):
+      search.best = ([m.id for m in merged_friday],
+                     [m.id for m in merged_saturday])
+
+def partition_pc(pcdb, strategy="random", time_limit=None, jobs=1, seed=None,
+                 target=None, checkpoint=None, storage_saturday=False,
+                 checkpoint_interval=300):
+  """ Partition the PC into Friday and Saturday groups.
+
+  The random, smart and anneal strategies spread their trials over jobs
+  processes seeded from seed; anneal runs one annealing trial per process.
+  They stop early after time_limit seconds or once the score reaches target,
+  and save their progress to checkpoint (if given) every checkpoint_interval
+  seconds, so that an interrupted run can be resumed. The exact strategy stops after time_limit
+  seconds (10 minutes by default). storage_saturday applies the storage rule
+  of allowed_days.
+  """
+  search_options = {"budget": time_limit,
+                    "target": target,
+                    "checkpoint": checkpoint,
+                    "checkpoint_interval": checkpoint_interval}
+  topic_matrix = TopicMatrix(pcdb)
+  friday, saturday, either, both = split_by_tag(pcdb)
+  args = (friday, saturday, either, both, topic_matrix)
 
   if strategy == "random":
     merged_friday, merged_saturday = find_best_merging_random(
-        friday, saturday, either, both, total_topics)
+        *args, storage_saturday=storage_saturday, jobs=jobs, seed=seed,
+        **search_options)
+  elif strategy == "exact":
+    if time_limit is None:
+      time_limit = 600
+    best_dist, score, lower_bound = find_best_merging_exact(
+        friday, saturday, either, both, topic_matrix, time_limit,
+        storage_saturday)
+    merged_friday, merged_saturday = best_dist
+  elif strategy == "anneal":
+    min_score, best_ids = base.run_trials(
+        anneal_merging_trials, args + (storage_saturday,), jobs, jobs, seed,
+        **search_options)
+    lookup = members_by_id((friday, saturday, either, both))
+    merged_friday, merged_saturday = tuple(
+        [lookup[i] for i in ids] for ids in best_ids)
   else:
     merged_friday, merged_saturday = find_best_merging_smart(
-        friday, saturday, either, both, total_topics)
+        *args, storage_saturday=storage_saturday, jobs=jobs, seed=seed,
+        **search_options)
 
   return merged_friday, merged_saturday
 
+def kway_day_choices(member, num_days):
+  """ List the sets of days (tuples of day indices) open to a PC member.
+
+  Members tagged PC_DayN attend day N, PC_Any members attend any single day
+  and PC_All members attend any single day or all of them. For two days the
+  Friday/Saturday/Either/Both tags are accepted as well. Untagged members get
+  no choices and are left out of the partition.
+  """
+  all_days = tuple(range(num_days))
+  day_tags = [DAY_TAG % (d + 1) for d in all_days]
+  any_tags = [ANY_TAG]
+  all_tags = [ALL_TAG]
+  if num_days == 2:
+    day_tags = [[FRIDAY_TAG, day_tags[0]], [SATURDAY_TAG, day_tags[1]]]
+    any_tags.append(EITHER_TAG)
+    all_tags.append(BOTH_TAG)
+  else:
+    day_tags = [[tag] for tag in day_tags]
+
+  for d, tags in enumerate(day_tags):
+    if any(tag in member.tags for tag in tags):
+      return [(d,)]
+  if any(tag in member.tags for tag in any_tags):
+    return [(d,) for d in all_days]
+  if any(tag in member.tags for tag in all_tags):
+    return [(d,) for d in all_days] + [all_days]
+  return []
+
+def compute_kway_score(group_counts):
+  """ Topic imbalance of a days x topics matrix of topic counts.
+
+  The score is the sum over days and topics of the distance between a day's
+  count and the mean count of that topic over all days. For two days this is
+  the same as compute_combined_score.
+  """
+  num_days = group_counts.shape[0]
+  total = group_counts.sum(axis=0)
+  return np.abs(num_days * group_counts - total).sum() / float(num_days)
+
+def kway_anneal_trials(args, search):
+  """ Anneal random K-way partitions, keeping the best day picks in search.
+
+  Each trial starts from a random choice of days for every member and
+  repeatedly moves one member to another of its allowed sets of days. A move
+  only changes the columns of the moved member's topics, so its score change
+  costs O(days x member topics).
+  """
+  choices, rows, num_days, iterations, start_temp, end_temp = args
+  flexible = [k for k in range(len(choices)) if len(choices[k]) > 1]
+  topic_idx = [np.flatnonzero(row) for row in rows]
+  day_vectors = [[np.bincount(days, minlength=num_days)[:, np.newaxis]
+                  for days in member_choices] for member_choices in choices]
+  cooling = (end_temp / start_temp) ** (1.0 / max(iterations, 1))
+
+  while search.running():
+    picks = [np.random.randint(len(member_choices))
+             for member_choices in choices]
+    counts = np.zeros((num_days, rows.shape[1]), dtype=np.int64)
+    for k, pick in enumerate(picks):
+      counts += day_vectors[k][pick] * rows[k]
+    score = np.abs(num_days * counts - counts.sum(axis=0)).sum()
+    min_score = score
+    best_picks = list(picks)
+
+    temp = start_temp * num_days
+    for i in range(iterations if flexible else 0):
+      temp *= cooling
+      k = flexible[np.random.randint(len(flexible))]
+      pick = np.random.randint(len(choices[k]) - 1)
+      if pick >= picks[k]:
+        pick += 1
+      idx = topic_idx[k]
+      old_block = counts[:, idx]
+      new_block = old_block + (day_vectors[k][pick] -
+                               day_vectors[k][picks[k]]) * rows[k][idx]
+      delta = (np.abs(num_days * new_block - new_block.sum(axis=0)).sum() -
+               np.abs(num_days * old_block - old_block.sum(axis=0)).sum())
+      if delta <= 0 or np.random.random() < np.exp(-delta / temp):
+        counts[:, idx] = new_block
+        picks[k] = pick
+        score += delta
+        if score < min_score:
+          min_score = score
+          best_picks = list(picks)
+
+    if search.record(min_score / float(num_days)):
+      search.best = best_picks
+
+def partition_pc_kway(pcdb, num_days, trials=10, iterations=50000,
+                      start_temp=3.0, end_temp=0.2, jobs=1, seed=None,
+                      time_limit=None, target=None, checkpoint=None,
+                      checkpoint_interval=300):
+  """ Partition the PC into num_days groups with balanced topics.
+
+  Runs trials independent annealing runs of kway_anneal_trials, spread over
+  jobs processes, and returns a list of num_days lists of members. The
+  search options are the same as for partition_pc.
+  """
+  topic_matrix = TopicMatrix(pcdb)
+  members = [member for member in pcdb]
+  choices = [kway_day_choices(member, num_days) for member in members]
+  members = [m for m, c in zip(members, choices) if c]
+  choices = [c for c in choices if c]
+  rows = np.array([topic_matrix.row(member) for member in members],
+                  dtype=np.int64).reshape(len(members), len(topic_matrix.topics))
+
+  min_score, best_picks = base.run_trials(
+      kway_anneal_trials,
+      (choices, rows, num_days, iterations, start_temp, end_temp),
+      trials, jobs, seed, budget=time_limit, target=target,
+      checkpoint=checkpoint, checkpoint_interval=checkpoint_interval)
+
+  groups = [[] for d in range(num_days)]
+  for member, member_choices, pick in zip(members, choices, best_picks):
+    for d in member_choices[pick]:
+      groups[d].append(member)
+  return groups
+
+def verify_kway_partition(groups):
+  """ Verify that every member of each group may attend that day. """
+  num_days = len(groups)
+  for d, group in enumerate(groups):
+    for member in group:
+      assert(any(d in days for days in kway_day_choices(member, num_days)))
+
+  print "%d-way partition verified" % num_days
+
 def print_partition(group, label, pcdb):
   topics_dist = count_topics(group)
   total_topics = count_topics(pcdb)
@@ -322,12 +873,49 @@ def verify_partition(group, tag):
 
   print "%s group verified" % tag
 
+def verify_allowed_days(friday, saturday, storage_saturday=False):
+  """ Verify that each flexible member got one of its allowed_days. """
+  friday_ids = member_ids(friday)
+  saturday_ids = member_ids(saturday)
+  for member in members_by_id((friday, saturday)).itervalues():
+    if (FRIDAY_TAG not in member.tags and SATURDAY_TAG not in member.tags and
+        (EITHER_TAG in member.tags or BOTH_TAG in member.tags)):
+      placed = (member.id in friday_ids, member.id in saturday_ids)
+      assert placed in allowed_days(member, storage_saturday), (
+          "%s is not allowed on %s" % (member, placed))
+
+  print "Allowed days verified"
+
 def verify_all_pc_members_present(friday, saturday, pcdb):
   check = set(friday) | set(saturday)
   for member in pcdb:
     if not member.is_epc and not member in check:
       print member, "missing!"
 
+def verify_incremental_merge(pcdb, seed=0, trials=20):
+  """ Verify that incremental and from-scratch smart merges are identical.
+
+  Both versions of merge_groups_smart are run from the same random state for
+  each trial and must produce the same Friday and Saturday lists.
+  """
+  topic_matrix = TopicMatrix(pcdb)
+  groups = split_by_tag(pcdb)
+  saved_state = (random.getstate(), np.random.get_state())
+  for trial in range(trials):
+    results = []
+    for incremental in (True, False):
+      random.seed(seed + trial)
+      np.random.seed(seed + trial)
+      friday, saturday, either, both = [list(g) for g in groups]
+      friday, saturday = merge_groups_smart(
+          friday, saturday, either, both, topic_matrix, incremental)
+      results.append(([m.id for m in friday], [m.id for m in saturday]))
+    assert(results[0] == results[1])
+  random.setstate(saved_state[0])
+  np.random.set_state(saved_state[1])
+
+  print "Incremental merge verified"
+
 def read_partition_file(fname, pcdb):
   group = []
   # idre = re.compile("^[0-9]+(?=:)")
@@ -1,9 +1,24 @@
+# Plots for the PC meeting.
+#
+# The statistics behind all plots are gathered in one scan of the databases
+# (meeting_stats) and also saved as plots/stats.json. Each plot is a job: the
+# numbers it shows are taken from the statistics in the main process, and a
+# plot_* function draws them. Jobs are rendered in a process pool, and a job
+# whose numbers and plot function are unchanged since the last run is
+# skipped (see render_plots).
+
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import time
 import matplotlib as mpl
 mpl.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 import programcommittee
+import reviews
 import submissions
 import institutions
 
@@ -22,25 +37,85 @@ def matplotlib_init():
     mpl.rc("ytick", labelsize=FONT_SIZE)
     mpl.rc("legend", **{"fontsize": FONT_SIZE-2})
 
-def plot_topic_distribution(paperdb):
-  topic_dist = {}
-  for paper in paperdb:
+def meeting_stats(paperdb, reviewdb):
+  """ Gather the statistics of all PC meeting plots in one pass.
+
+  Returns a dict of arrays:
+    paper_ids: the papers, in paperdb order.
+    main_pc_conflicts, total_pc_conflicts: PC conflicts of each paper,
+      without and with the EPC.
+    average_scores, pre_rebuttal_average_scores: mean overall merit of each
+      paper after and before the rebuttal (NaN for papers without reviews).
+    topics, topic_counts: the topics of all papers (sorted) and the number
+      of papers of each.
+    score_histograms: for each score category, the number of reviews giving
+      each score from 1 to 5.
+    rebuttal_changes: the number of reviews whose overall merit went down,
+      stayed and went up after the rebuttal.
+  """
+  papers = [paper for paper in paperdb]
+  num_papers = len(papers)
+  paper_ids = np.zeros(num_papers, dtype=np.int64)
+  main_pc_conflicts = np.zeros(num_papers, dtype=np.int64)
+  total_pc_conflicts = np.zeros(num_papers, dtype=np.int64)
+  topic_counts = {}
+  for i, paper in enumerate(papers):
+    paper_ids[i] = paper.id
+    total_pc_conflicts[i] = len(paper.pc_conflicts)
+    main_pc_conflicts[i] = sum(1 for conf in paper.pc_conflicts
+                               if not conf.is_epc)
     for topic in paper.topics:
-      if topic in topic_dist:
-        topic_dist[topic] += 1
-      else:
-        topic_dist[topic] = 1
-
-  hist = np.array([v for v in topic_dist.itervalues()])
-  topic_names = [k for k in topic_dist.iterkeys()]
-  for i in range(len(topic_names)):
-    topic_names[i] = re.sub("\(.*\)", "", topic_names[i]).strip()
-  topic_names = np.array(topic_names)
-
-  idx = np.argsort(hist)
-  hist = hist[idx]
-  topic_names = topic_names[idx]
-
+      topic_counts[topic] = topic_counts.get(topic, 0) + 1
+  topics = sorted(topic_counts)
+
+  # Papers without reviews are not in the score table.
+  rows = np.searchsorted(reviewdb.paper_ids, paper_ids)
+  reviewed = rows < len(reviewdb.paper_ids)
+  reviewed[reviewed] = reviewdb.paper_ids[rows[reviewed]] == paper_ids[reviewed]
+  def per_paper(paper_means):
+    means = np.full(num_papers, np.nan)
+    means[reviewed] = paper_means[rows[reviewed]]
+    return means
+
+  mean_change, rebuttal_changes = reviewdb.rebuttal_changes()
+  return {
+      "paper_ids": paper_ids,
+      "main_pc_conflicts": main_pc_conflicts,
+      "total_pc_conflicts": total_pc_conflicts,
+      "average_scores": per_paper(
+          reviewdb.paper_means("Post rebuttal overall merit")),
+      "pre_rebuttal_average_scores": per_paper(
+          reviewdb.paper_means("Overall merit")),
+      "topics": topics,
+      "topic_counts": np.array([topic_counts[t] for t in topics],
+                               dtype=np.int64),
+      "score_histograms": dict((category, reviewdb.score_histogram(category))
+                               for category in reviews.SCORE_CATEGORIES),
+      "rebuttal_changes": np.array(rebuttal_changes, dtype=np.int64),
+  }
+
+def write_stats(fname, stats):
+  """ Save meeting_stats as JSON, with NaN as null. """
+  def to_json(value):
+    if isinstance(value, dict):
+      return dict((k, to_json(v)) for k, v in value.iteritems())
+    if isinstance(value, np.ndarray):
+      if value.dtype.kind == "f":
+        return [None if np.isnan(v) else v for v in value.tolist()]
+      return value.tolist()
+    return value
+  with open(fname, "w") as f:
+    json.dump(to_json(stats), f, indent=2, sort_keys=True)
+
+def topic_distribution(stats):
+  """ Number of papers per topic, and the short topic names, by count. """
+  hist = stats["topic_counts"]
+  topic_names = np.array([re.sub("\(.*\)", "", topic).strip()
+                          for topic in stats["topics"]])
+  idx = np.argsort(hist, kind="mergesort")
+  return hist[idx], topic_names[idx]
+
+def plot_topic_distribution(hist, topic_names):
   fig = plt.figure()
   fig.set_figheight(7)
   fig.set_figwidth(8)
@@ -59,21 +134,12 @@ def plot_topic_distribution(paperdb):
   ax.tick_params(axis="x", which="both", bottom="off", top="off")
   ax.tick_params(axis="y", which="both", right="off")
 
-  plt.savefig("plots/topic_distribution.png", bbox_inches="tight")
-
-def get_score_distribution(paperdb, category):
-  buckets = np.zeros(5)
-  for paper in paperdb:
-    for review in paper.reviews:
-      score = review.scores[category]
-      buckets[score-1] += 1
-
-  return buckets
+  return fig
 
-def plot_overall_merit_score_distribution(paperdb):
-  pre_reb_buckets = get_score_distribution(paperdb, "Overall merit")
-  post_reb_buckets = get_score_distribution(paperdb, "Post rebuttal overall merit")
+def get_score_distribution(stats, category):
+  return stats["score_histograms"][category]
 
+def plot_overall_merit_score_distribution(pre_reb_buckets, post_reb_buckets):
   fig = plt.figure()
   ax = fig.add_subplot(111)
   x_centers = np.arange(5) + 1
@@ -95,11 +161,9 @@ def plot_overall_merit_score_distribution(paperdb):
   ax.set_axisbelow(True)
   ax.legend(loc=0)
 
-  plt.savefig("plots/score_distribution.png", bbox_inches="tight")
-
-def plot_score_distribution(paperdb, category):
-  hist = get_score_distribution(paperdb, category)
+  return fig
 
+def plot_score_distribution(hist, category):
   fig = plt.figure()
   ax = fig.add_subplot(111)
   x_centers = np.arange(5) + 1
@@ -119,21 +183,12 @@ def plot_score_distribution(paperdb, category):
   ax.set_axisbelow(True)
   ax.legend(loc=0)
 
-  category = category.replace(" ", "_")
-  plt.savefig("plots/%s_distribution.png" % category, bbox_inches="tight")
-
-def plot_conflicts_per_paper(paperdb, pcdb):
-  main_pc_conflict_data = []
-  total_pc_conflict_data = []
-  for paper in paperdb:
-    conflicts = paper.pc_conflicts
-    num_main_pc_conf = 0
-    num_total_pc_conf = len(conflicts)
-    for conf in conflicts:
-      if not conf.is_epc:
-        num_main_pc_conf += 1
-    main_pc_conflict_data.append(num_main_pc_conf)
-    total_pc_conflict_data.append(num_total_pc_conf)
+  return fig
+
+def conflicts_per_paper(stats):
+  """ Histograms of main PC and PC+EPC conflicts per paper, and their bins. """
+  main_pc_conflict_data = stats["main_pc_conflicts"]
+  total_pc_conflict_data = stats["total_pc_conflicts"]
 
   max_conflicts = np.max(total_pc_conflict_data)
   print "Average main PC conflicts per paper: %f" % (np.mean(main_pc_conflict_data))
@@ -147,7 +202,10 @@ def plot_conflicts_per_paper(paperdb, pcdb):
       main_pc_conflict_data, bins=bins)
   total_pc_hist, total_pc_edges = np.histogram(
       total_pc_conflict_data, bins=bins)
+  return main_pc_hist, total_pc_hist, bins
 
+def plot_conflicts_per_paper(main_pc_hist, total_pc_hist, bins):
+  main_pc_edges = bins
   fig = plt.figure()
   ax = fig.add_subplot(111)
   x_centers = np.array(bins)
@@ -174,30 +232,31 @@ def plot_conflicts_per_paper(paperdb, pcdb):
   ax.set_xticklabels(x_centers)
   ax.legend(loc=0)
 
-  plt.savefig("plots/conflict_distribution.png", bbox_inches="tight")
+  return fig
 
-def plot_average_score_distribution(
-      paperdb, discuss_list, online_accept_list, prefix="post"):
-  discuss_average_scores = []
-  for paper_id in discuss_list:
-    paper = paperdb[paper_id]
-    discuss_average_scores.append(paper.get_average_score())
+def average_score_distribution(stats, discuss_list, online_accept_list):
+  """ Histograms of the average scores of two lists of papers, and the bins.
 
-  accept_average_scores = []
-  for paper_id in online_accept_list:
-    paper = paperdb[paper_id]
-    accept_average_scores.append(paper.get_average_score())
+  All the papers must have reviews.
+  """
+  index = dict((paper_id, i) for i, paper_id in
+               enumerate(stats["paper_ids"].tolist()))
+  average_scores = stats["average_scores"]
+  discuss_average_scores = average_scores[[index[p] for p in discuss_list]]
+  accept_average_scores = average_scores[[index[p] for p in online_accept_list]]
+  assert(not np.isnan(discuss_average_scores).any())
+  assert(not np.isnan(accept_average_scores).any())
 
   print "Average Friday:", np.mean(discuss_average_scores)
   print "Average Saturday:", np.mean(accept_average_scores)
 
-  discuss_average_scores = np.array(discuss_average_scores)
-  accept_average_scores = np.array(accept_average_scores)
-
   bins = np.arange(2.0, 5.0, 0.2)
   d_hist, d_edges = np.histogram(discuss_average_scores, bins=bins)
   a_hist, a_edges = np.histogram(accept_average_scores, bins=bins)
+  return d_hist, a_hist, bins
 
+def plot_average_score_distribution(d_hist, a_hist, bins):
+  d_edges = bins
   fig = plt.figure()
   ax = fig.add_subplot(111)
   x_centers = np.arange(len(bins))
@@ -219,16 +278,124 @@ def plot_average_score_distribution(
   ax.set_xlim(left=-bar_width)
   ax.legend(loc=0)
 
-  plt.savefig("plots/%s_average_score_distribution.png" % prefix,
-              bbox_inches="tight")
+  return fig
+
+# Digests of the plots rendered last, by file name.
+PLOT_CACHE = "plots/plot_cache.json"
+# Bump to redraw every plot after a style change that neither the plot
+# functions nor the matplotlib settings capture, e.g. in render_plot.
+PLOT_STYLE_VERSION = 1
+
+def plot_style_digest():
+  """ Hash the plot style.
 
-def plot_pc_meeting(paperdb, pcdb, instdb):
+  Covers matplotlib's version, its settings after matplotlib_init (which
+  include FONT_SIZE) and PLOT_STYLE_VERSION.
+  """
   matplotlib_init()
-  plot_topic_distribution(paperdb)
-  plot_overall_merit_score_distribution(paperdb)
-  plot_score_distribution(paperdb, "Reviewer expertise")
-  plot_score_distribution(paperdb, "Novelty")
-  plot_conflicts_per_paper(paperdb, pcdb)
+  return hashlib.sha1(repr((PLOT_STYLE_VERSION, mpl.__version__,
+                            sorted(mpl.rcParams.items())))).hexdigest()
+
+def plot_digest(plot, args, style=""):
+  """ Hash a plot function's code and the statistics it is drawn from.
+
+  style, from plot_style_digest, makes a style change redraw every plot.
+  """
+  digest = hashlib.sha1()
+  digest.update(style)
+  def update_code(code):
+    digest.update(code.co_code)
+    # Attribute, global and local names are not part of co_code.
+    digest.update(repr((code.co_names, code.co_varnames, code.co_freevars,
+                        code.co_cellvars)))
+    # Nested code objects would put their addresses in the repr.
+    digest.update(repr([c for c in code.co_consts if not hasattr(c, "co_code")]))
+    for c in code.co_consts:
+      if hasattr(c, "co_code"):
+        update_code(c)
+  update_code(plot.func_code)
+  def update(value):
+    if isinstance(value, np.ndarray):
+      digest.update("%s %s" % (value.dtype.str, value.shape))
+      digest.update(np.ascontiguousarray(value).tostring())
+    elif isinstance(value, (list, tuple)):
+      digest.update("%s %d" % (type(value).__name__, len(value)))
+      for item in value:
+        update(item)
+    else:
+      digest.update(repr(value))
+  update(args)
+  return digest.hexdigest()
+
+def render_plot(job):
+  """ Draw and save one (file name, plot function, arguments) job.
+
+  Returns the time it took in seconds.
+  """
+  start = time.time()
+  fname, plot, args = job
+  fig = plot(*args)
+  fig.savefig(fname, bbox_inches="tight")
+  plt.close(fig)
+  return time.time() - start
+
+def render_plots(plot_jobs, jobs=1):
+  """ Render the plot jobs that changed since the last run in jobs processes.
+
+  Prints the time each plot took.
+  """
+  try:
+    with open(PLOT_CACHE, "r") as f:
+      cache = json.load(f)
+  except (IOError, ValueError):
+    cache = {}
+  style = plot_style_digest()
+  digests = dict((fname, plot_digest(plot, args, style))
+                 for fname, plot, args in plot_jobs)
+  todo = [job for job in plot_jobs
+          if cache.get(job[0]) != digests[job[0]] or not os.path.exists(job[0])]
+
+  if jobs > 1 and len(todo) > 1:
+    pool = multiprocessing.Pool(min(jobs, len(todo)), matplotlib_init)
+    try:
+      times = pool.map(render_plot, todo, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    times = [render_plot(job) for job in todo]
+
+  rendered = dict((job[0], t) for job, t in zip(todo, times))
+  for fname, plot, args in plot_jobs:
+    if fname in rendered:
+      print "%s: %.2f s" % (fname, rendered[fname])
+    else:
+      print "%s: unchanged" % fname
+  cache.update(digests)
+  with open(PLOT_CACHE, "w") as f:
+    json.dump(cache, f, indent=2, sort_keys=True)
+
+def plot_pc_meeting(paperdb, pcdb, instdb, reviewdb=None, jobs=1):
+  if reviewdb is None or not hasattr(reviewdb, "score_table"):
+    reviewdb = reviews.ReviewDB(
+        [review for paper in paperdb for review in paper.reviews])
+  stats = meeting_stats(paperdb, reviewdb)
+  write_stats("plots/stats.json", stats)
+  print "Reviews changed after rebuttal: %d down, %d same, %d up" % tuple(
+      stats["rebuttal_changes"])
+  plot_jobs = [
+      ("plots/topic_distribution.png", plot_topic_distribution,
+       topic_distribution(stats)),
+      ("plots/score_distribution.png", plot_overall_merit_score_distribution,
+       (get_score_distribution(stats, "Overall merit"),
+        get_score_distribution(stats, "Post rebuttal overall merit")))]
+  for category in ["Reviewer expertise", "Novelty"]:
+    plot_jobs.append(
+        ("plots/%s_distribution.png" % category.replace(" ", "_"),
+         plot_score_distribution,
+         (get_score_distribution(stats, category), category)))
+  plot_jobs.append(("plots/conflict_distribution.png", plot_conflicts_per_paper,
+                    conflicts_per_paper(stats)))
 
   friday_papers = submissions.read_paper_id_list(
       "data/friday_papers_final.txt")
@@ -242,14 +409,19 @@ def plot_pc_meeting(paperdb, pcdb, instdb):
   all_discuss_papers = friday_papers + saturday_papers
   all_online_accept = friday_online_accept + saturday_online_accept
 
-  # plot_average_score_distribution(
-  #     paperdb, friday_papers, friday_online_accept, "friday_post")
-  # plot_average_score_distribution(
-  #     paperdb, saturday_papers, saturday_online_accept, "saturday_post")
-  plot_average_score_distribution(
-      paperdb, friday_papers, saturday_papers, "comparison_post")
-  plot_average_score_distribution(
-      paperdb, friday_papers + friday_online_accept,
-      saturday_papers + saturday_online_accept, "comparison_oa_post")
-  # plot_average_score_distribution(
-  #     paperdb, all_discuss_papers, all_online_accept, "all_post")
+  average_score_lists = [
+      # ("friday_post", friday_papers, friday_online_accept),
+      # ("saturday_post", saturday_papers, saturday_online_accept),
+      ("comparison_post", friday_papers, saturday_papers),
+      ("comparison_oa_post", friday_papers + friday_online_accept,
+       saturday_papers + saturday_online_accept),
+      # ("all_post", all_discuss_papers, all_online_accept),
+  ]
+  for prefix, discuss_list, online_accept_list in average_score_lists:
+    plot_jobs.append(
+        ("plots/%s_average_score_distribution.png" % prefix,
+         plot_average_score_distribution,
+         average_score_distribution(stats, discuss_list,
+                                    online_accept_list)))
+
+  render_plots(plot_jobs, jobs)
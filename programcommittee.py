@@ -28,8 +28,8 @@ class Person(base.BaseObj):
     self.tags = tags.split()
     Person._id += 1
 
-    # List of papers that they were assigned.
-    self.assignments = []
+    # Set of ids of the papers that they were assigned.
+    self.assignments = set()
 
     # Parse topics list.
     # Preferences go [-2, -1, <empty>, 2, 4]
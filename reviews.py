@@ -1,11 +1,176 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import mmap
+import multiprocessing
+import os
+import random
 import re
-import codecs
+import time
+
+import numpy as np
 
 import base
 
+# Score categories, as HotCRP names them in the review dump.
+SCORE_CATEGORIES = ["Post rebuttal overall merit",
+                    "Overall merit",
+                    "Novelty",
+                    "Writing quality",
+                    "Reviewer expertise"]
+
+def score_column(category):
+  """ Name of the score table column of a score category. """
+  return category.lower().replace(" ", "_")
+
+# The HotCRP offline form of one review, filled in by Review.offline_form with
+# the reviewer, email, paper id and the scores in SCORE_CATEGORIES order. The
+# text fields (F. Paper summary to L. Post rebuttal comments to authors) are
+# left out, so uploading the forms only changes the scores.
+OFFLINE_FORM_TEMPLATE = (
+    u"==+== =====================================================================\n"
+    u"==+== Begin Review\n"
+    u"==+== Version 20\n"
+    u"==+== Reviewer: %s <%s>\n"
+    u"\n"
+    u"==+== Paper #%d\n"
+    u"==+== Review Readiness\n"
+    u"\n"
+    u"Ready\n"
+    u"\n"
+    u"==+== A. Post rebuttal overall merit (hidden from authors)\n"
+    u"%d\n"
+    u"==+== B. Overall merit\n"
+    u"%d\n"
+    u"==+== C. Novelty\n"
+    u"%d\n"
+    u"==+== D. Writing quality\n"
+    u"%d\n"
+    u"==+== E. Reviewer expertise\n"
+    u"%d\n"
+    u"==+== End Review\n"
+    u"\n")
+
+# Offline forms are written to disk in blocks of about this many bytes.
+OFFLINE_FORM_BLOCK = 1 << 20
+
+def write_offline_forms(fname, review_list, header=u"", max_bytes=None):
+  """ Write the offline forms of review_list, starting with header.
+
+  Forms are written as they are rendered, buffered in large blocks. If
+  max_bytes is given, the forms are split over files of at most max_bytes
+  each (a single form larger than that gets a file of its own), named like
+  reviews-1.txt, reviews-2.txt for fname reviews.txt, and every file starts
+  with header. Returns the names of the files written.
+  """
+  header = header.encode("utf-8")
+  root, ext = os.path.splitext(fname)
+  fnames = []
+  f = None
+  try:
+    for review in review_list:
+      form = review.offline_form().encode("utf-8")
+      if f is None or (max_bytes is not None and shard_size > len(header) and
+                       shard_size + len(form) > max_bytes):
+        if f is not None:
+          f.write("".join(block))
+          f.close()
+        if max_bytes is None:
+          fnames.append(fname)
+        else:
+          fnames.append("%s-%d%s" % (root, len(fnames) + 1, ext))
+        f = open(fnames[-1], "wb")
+        block = [header]
+        block_size = shard_size = len(header)
+      block.append(form)
+      block_size += len(form)
+      shard_size += len(form)
+      if block_size >= OFFLINE_FORM_BLOCK:
+        f.write("".join(block))
+        block = []
+        block_size = 0
+    if f is None:
+      # No reviews: still write the header.
+      fnames.append(fname if max_bytes is None else "%s-1%s" % (root, ext))
+      f = open(fnames[-1], "wb")
+      block = [header]
+    f.write("".join(block))
+  finally:
+    if f is not None:
+      f.close()
+  return fnames
+
+class ReviewSource(object):
+  """ A review dump that review text is read from on demand.
+
+  The file is memory mapped on first use. Pickled copies drop the mapping
+  and map the file again when needed, so they refuse to read from a dump
+  that changed since it was parsed.
+  """
+
+  def __init__(self, fname):
+    self.fname = os.path.abspath(fname)
+    self.stamp = self.file_stamp()
+    self.data_ = None
+
+  def file_stamp(self):
+    stat = os.stat(self.fname)
+    return (stat.st_size, stat.st_mtime)
+
+  def read(self, offset, length):
+    """ Return length bytes of the dump starting at offset. """
+    if self.data_ is None:
+      if self.file_stamp() != self.stamp:
+        raise IOError("%s changed since it was parsed" % self.fname)
+      with open(self.fname, "rb") as f:
+        self.data_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self.data_[offset:offset + length]
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["data_"] = None
+    return state
+
+def field_text(raw):
+  """ Convert the raw lines of a review field into its text. """
+  lines = raw.split("\n")
+  if raw.endswith("\n"):
+    lines.pop()
+  return "\n".join(line.strip() for line in lines).decode("utf-8")
+
+class LazyText(object):
+  """ A review text field, read from the review's source when accessed.
+
+  The review keeps an (offset, length) span of the field in its source. Text
+  assigned to the field is kept as is.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, review, cls):
+    if review is None:
+      return self
+    if self.name in review.__dict__:
+      return review.__dict__[self.name]
+    span = getattr(review, "spans", {}).get(self.name)
+    if span is None:
+      return ""
+    return field_text(review.source.read(*span))
+
+  def __set__(self, review, value):
+    review.__dict__[self.name] = value
+
 class Review(base.BaseObj):
+  # Review text is only read from the dump when it is used (see LazyText).
+  paper_summary = LazyText("paper_summary")
+  strengths = LazyText("strengths")
+  weaknesses = LazyText("weaknesses")
+  comments_to_authors = LazyText("comments_to_authors")
+  post_reb_comments_to_authors = LazyText("post_reb_comments_to_authors")
+  questions_for_authors = LazyText("questions_for_authors")
+  comments_to_PC = LazyText("comments_to_PC")
+
   def __init__(self, name):
     super(Review, self).__init__()
     self.name = name
@@ -21,21 +186,12 @@ class Review(base.BaseObj):
     self.id = self.paper_id * 10 + review_num
 
     # These keys are designed to match what HotCRP dumps in the review text.
-    self.scores = {
-        "Post rebuttal overall merit": 0,
-        "Overall merit": 0,
-        "Novelty": 0,
-        "Writing quality": 0,
-        "Reviewer expertise": 0}
-
-    # Ignore review text for now. We don't need it.
-    self.paper_summary = ""
-    self.strengths = ""
-    self.weaknesses = ""
-    self.comments_to_authors = ""
-    self.post_reb_comments_to_authors = ""
-    self.questions_for_authors = ""
-    self.comments_to_PC = ""
+    self.scores = dict((category, 0) for category in SCORE_CATEGORIES)
+
+    # Where the review text is: a ReviewSource and the (offset, length) span
+    # of each text field in it.
+    self.source = None
+    self.spans = {}
 
   def set_scores(self, scores):
     assert(isinstance(scores, dict))
@@ -46,44 +202,14 @@ class Review(base.BaseObj):
     if self.scores[postRebScore] == 0:
       self.scores[postRebScore] = self.scores["Overall merit"]
 
+  def offline_form(self):
+    """ The HotCRP offline form of this review, as unicode. """
+    return OFFLINE_FORM_TEMPLATE % (
+        (self.reviewer, self.reviewer_email, self.paper_id) +
+        tuple(self.scores[category] for category in SCORE_CATEGORIES))
+
   def print_offline_form(self, form_file):
-    print >>form_file, "==+== ====================================================================="
-    print >>form_file, "==+== Begin Review"
-    print >>form_file, "==+== Version 20"
-    print >>form_file, "==+== Reviewer:", self.reviewer, "<%s>" % self.reviewer_email
-    print >>form_file, ""
-    print >>form_file, "==+== Paper #%d" % self.paper_id
-    print >>form_file, "==+== Review Readiness"
-    print >>form_file, ""
-    print >>form_file, "Ready"
-    print >>form_file, ""
-    print >>form_file, "==+== A. Post rebuttal overall merit (hidden from authors)"
-    print >>form_file, self.scores["Post rebuttal overall merit"]
-    print >>form_file, "==+== B. Overall merit"
-    print >>form_file, self.scores["Overall merit"]
-    print >>form_file, "==+== C. Novelty"
-    print >>form_file, self.scores["Novelty"]
-    print >>form_file, "==+== D. Writing quality"
-    print >>form_file, self.scores["Writing quality"]
-    print >>form_file, "==+== E. Reviewer expertise"
-    print >>form_file, self.scores["Reviewer expertise"]
-    # print >>form_file, "==+== F. Paper summary"
-    # print >>form_file, self.paper_summary
-    # print >>form_file, "==+== G. Strengths"
-    # print >>form_file, self.strengths
-    # print >>form_file, "==+== H. Weaknesses"
-    # print >>form_file, self.weaknesses
-    # print >>form_file, "==+== I. Comments to authors"
-    # print >>form_file, self.comments_to_authors
-    # print >>form_file, u"==+== J. Questions for authors’ response"
-    # print >>form_file, self.questions_for_authors
-    # print >>form_file, "==+== K. Comments to PC (hidden from authors)"
-    # print >>form_file, self.comments_to_PC
-    # print >>form_file, "==+== L. Post rebuttal comments to authors (hidden from authors)"
-    # print >>form_file, self.post_reb_comments_to_authors
-    # print >>form_file, "==+== Scratchpad"
-    print >>form_file, "==+== End Review"
-    print >>form_file, ""
+    form_file.write(self.offline_form())
 
   def __unicode__(self):
     scores = tuple(v for v in self.scores.itervalues())
@@ -95,120 +221,499 @@ class Review(base.BaseObj):
   def __repr__(self):
     return str(self)
 
+def reviewer_key(review):
+  """ The (key, label) that identifies the reviewer of a review.
+
+  Reviewers are identified by email. A review without one is keyed by its
+  reviewer's name, or failing that by the review itself, so that unrelated
+  reviews are not lumped together as one reviewer.
+  """
+  if review.reviewer_email:
+    return ("email", review.reviewer_email), review.reviewer_email
+  if review.reviewer:
+    return ("name", review.reviewer), review.reviewer
+  return ("review", review.name), u"review %s" % review.name
+
 class ReviewDB(base.BaseDB):
+  # Besides the reviews, the DB keeps a score table: a NumPy structured array
+  # with one row per review (in dump order) and the columns paper_id,
+  # reviewer (an index into reviewer_emails, see reviewer_key) and one column
+  # per score category (see score_column). paper_ids lists the reviewed papers in
+  # increasing order and paper_rows gives the position of each row's paper in
+  # paper_ids, so per-paper aggregates are single bincount calls.
+
   def __init__(self, review_list):
+    self.set_reviews(review_list)
+
+  def set_reviews(self, review_list):
+    """ Replace the reviews of the DB. """
     super(ReviewDB, self).__init__(review_list)
+    # The reviews in the order of the dump.
+    self.reviews = list(review_list)
+    self.build_score_table()
 
-def read_reviewdb(fname):
-  REVIEW_BEGIN = "ISCA 2017 Review #"
-  REVIEW_SUMMARY = "===== Paper summary ====="
-  REVIEW_STRENGTHS = "===== Strengths ====="
-  REVIEW_WEAKNESSES = "===== Weaknesses ====="
-  REVIEW_AUTHOR_COMMENTS = "===== Comments to authors ====="
-  REVIEW_AUTHOR_QUESTIONS = u"===== Questions for authors’ response ====="
-  REVIEW_PC_COMMENTS = "===== Comments to PC ====="
-  REVIEW_POST_REB_COMMENTS = "===== Post rebuttal comments to authors ====="
-  REVIEW_BIG_SEPARATOR = "======================="
-  REVIEW_MEDIUM_SEPARATOR = "====="
-  REVIEW_SMALL_SEPARATOR = "----------"
-  REVIEWER = "Reviewer:"
-  review_id_re = re.compile("(?<=ISCA 2017 Review #)[0-9A-Z]+")
-  reviewer_re = re.compile("(?<=Reviewer: ).*")
-  # Score lines contain the category name, the score, and the description.
-  score_re = re.compile("(\w[\w\s,-]+|\d+)")
-  review_list = []
-  with codecs.open(fname, encoding="utf-8") as review_file:
-    current_review = None
-    while True:
-      line = review_file.readline()
-      if not line:
-        break
+  def build_score_table(self):
+    """ Build the score table and paper index from the reviews. """
+    dtype = ([("paper_id", np.int64), ("reviewer", np.int64)] +
+             [(score_column(c), np.int64) for c in SCORE_CATEGORIES])
+    reviewer_index = {}
+    labels = []
+    rows = []
+    for review in self.reviews:
+      key, label = reviewer_key(review)
+      reviewer = reviewer_index.setdefault(key, len(reviewer_index))
+      if reviewer == len(labels):
+        labels.append(label)
+      rows.append((review.paper_id, reviewer) +
+                  tuple(review.scores.get(c, 0) for c in SCORE_CATEGORIES))
+    self.score_table = np.array(rows, dtype=dtype)
+    self.reviewer_emails = labels
+    self.paper_ids, self.paper_rows = np.unique(
+        self.score_table["paper_id"], return_inverse=True)
+    self.means_ = {}
+
+  def paper_means(self, category="Post rebuttal overall merit"):
+    """ Mean score of each paper in paper_ids. """
+    scores = self.score_table[score_column(category)]
+    return (np.bincount(self.paper_rows, weights=scores) /
+            np.bincount(self.paper_rows))
+
+  def paper_mean(self, paper_id, category="Post rebuttal overall merit"):
+    """ Mean score of one paper, which must have reviews.
+
+    The means of all papers are computed once per category and cached.
+    """
+    means = self.__dict__.setdefault("means_", {})
+    if category not in means:
+      means[category] = self.paper_means(category)
+    row = np.searchsorted(self.paper_ids, paper_id)
+    assert(row < len(self.paper_ids) and self.paper_ids[row] == paper_id)
+    return float(means[category][row])
+
+  def paper_means_of(self, paper_ids, category="Post rebuttal overall merit"):
+    """ Mean scores of the given papers, which must all have reviews. """
+    rows = np.searchsorted(self.paper_ids, paper_ids)
+    assert(np.all(rows < len(self.paper_ids)))
+    assert(np.all(self.paper_ids[rows] == paper_ids))
+    return self.paper_means(category)[rows]
+
+  def score_histogram(self, category, num_scores=5):
+    """ Number of reviews giving each score from 1 to num_scores.
+
+    Missing scores (0) are not counted.
+    """
+    scores = self.score_table[score_column(category)]
+    scores = scores[(scores >= 1) & (scores <= num_scores)]
+    return np.bincount(scores - 1, minlength=num_scores)
+
+  def rebuttal_changes(self):
+    """ Compare overall merit before and after the rebuttal.
+
+    Returns the per-paper mean change (in the order of paper_ids) and the
+    number of reviews whose score went down, stayed and went up.
+    """
+    change = (self.score_table["post_rebuttal_overall_merit"] -
+              self.score_table["overall_merit"])
+    mean_change = (np.bincount(self.paper_rows, weights=change) /
+                   np.bincount(self.paper_rows))
+    down, same, up = np.bincount(np.sign(change) + 1, minlength=3)
+    return mean_change, (down, same, up)
 
-      # Find the review id.
-      if not current_review and REVIEW_BEGIN in line:
-        review_id = re.findall(review_id_re, line)[0]
-        current_review = Review(review_id)
+# Markers of a HotCRP review dump, as UTF-8 byte strings.
+REVIEW_PREFIX = "ISCA 2017 Review #"
+REVIEW_SUMMARY = "===== Paper summary ====="
+REVIEW_STRENGTHS = "===== Strengths ====="
+REVIEW_WEAKNESSES = "===== Weaknesses ====="
+REVIEW_AUTHOR_COMMENTS = "===== Comments to authors ====="
+REVIEW_AUTHOR_QUESTIONS = u"===== Questions for authors’ response =====".encode("utf-8")
+REVIEW_PC_COMMENTS = "===== Comments to PC ====="
+REVIEW_POST_REB_COMMENTS = "===== Post rebuttal comments to authors ====="
+REVIEW_BIG_SEPARATOR = "======================="
+REVIEW_MEDIUM_SEPARATOR = "====="
+REVIEW_SMALL_SEPARATOR = "----------"
+REVIEWER = "Reviewer:"
+
+# Review attribute holding the text of each field.
+REVIEW_FIELDS = {
+    REVIEW_SUMMARY: "paper_summary",
+    REVIEW_STRENGTHS: "strengths",
+    REVIEW_WEAKNESSES: "weaknesses",
+    REVIEW_AUTHOR_COMMENTS: "comments_to_authors",
+    REVIEW_AUTHOR_QUESTIONS: "questions_for_authors",
+    REVIEW_PC_COMMENTS: "comments_to_PC",
+    REVIEW_POST_REB_COMMENTS: "post_reb_comments_to_authors"}
+
+review_id_re = re.compile("[0-9A-Z]+")
+email_re = re.compile("<(.*)>")
+# Score lines contain the category name, the score, and the description.
+score_re = re.compile("(\w[\w\s,-]+|\d+)")
+
+# Parser states, in the order they appear in a review.
+SEEK, REVIEWER_NAME, REVIEWER_EMAIL, SCORES_START, SCORES, TEXT, FIELD = range(7)
+
+def parse_reviews(lines, prefix=REVIEW_PREFIX, source=None, offset=0):
+  """ Parse the lines (UTF-8 byte strings) of a review dump into Reviews.
+
+  This is a generator: each review is yielded as soon as its last line has
+  been read. A review starts at a header line, as found by
+  find_review_header: a line containing prefix followed by the review id,
+  which is the first line of the input or follows a big separator line. It
+  ends at the next big separator line (or the end of input).
+
+  If the lines come from a ReviewSource, starting at byte offset, reviews
+  only record the spans of their text fields. Otherwise the text is kept.
+  """
+  state = SEEK
+  review = None
+  end = offset
+  after_separator = True
+  for line in lines:
+    start = end
+    end += len(line)
+    line = line.strip()
+    header = after_separator
+    after_separator = REVIEW_BIG_SEPARATOR in line
+    if state == SEEK:
+      pos = line.find(prefix) if header else -1
+      if pos != -1:
+        review_id = unicode(review_id_re.match(line, pos + len(prefix)).group())
+        review = Review(review_id)
+        review.source = source
+        scores = {}
+        state = REVIEWER_NAME
+
+    elif state == REVIEWER_NAME:
+      pos = line.find(REVIEWER)
+      if pos != -1:
+        reviewer = line[pos + len(REVIEWER):].decode("utf-8").strip()
+        match = email_re.search(reviewer)
+        # Remove the email address if it has one.
+        review.reviewer = email_re.sub("", reviewer).strip()
+        if match:
+          review.reviewer_email = match.group(1)
+          state = SCORES_START
+        else:
+          state = REVIEWER_EMAIL
+
+    elif state == REVIEWER_EMAIL:
+      # Reviewer email might be on the next line
+      match = email_re.search(line.decode("utf-8"))
+      if match:
+        review.reviewer_email = match.group(1)
       else:
+        print "Review %s is missing reviewer email" % review.name
+      state = SCORES_START
+
+    elif state == SCORES_START or state == SCORES:
+      if not line:
+        if state == SCORES:
+          state = TEXT
+        continue
+      if state == SCORES_START and REVIEW_SMALL_SEPARATOR in line:
         continue
+      score_match = score_re.findall(line.decode("utf-8"))
+      if len(score_match) == 3:
+        scores[score_match[0]] = int(score_match[1])
+      state = SCORES
 
-      print "Current review:", review_id
-
-      # Get the reviewer name.
-      while not REVIEWER in line:
-        line = review_file.readline()
-      reviewer = re.findall(reviewer_re, line)[0].strip()
-      reviewer_email = re.findall("(?<=<).*(?=>)", reviewer)
-      # Remove the email address if it has one.
-      reviewer = re.sub("<.*>", "", reviewer).strip()
-      if reviewer_email:
-        current_review.reviewer_email = reviewer_email[0]
-      else:
-        # Reviewer email might be on the next line
-        line = review_file.readline().strip()
-        reviewer_email = re.findall("(?<=<).*(?=>)", line)
-        if reviewer_email:
-          current_review.reviewer_email = reviewer_email[0]
+    elif state == FIELD and REVIEW_MEDIUM_SEPARATOR not in line:
+      if source is None:
+        content.append(line)
+
+    else:
+      if state == FIELD:
+        end_field(review, field, content, field_start, start)
+        state = TEXT
+      if REVIEW_BIG_SEPARATOR in line:
+        review.set_scores(scores)
+        review.fix_missing_scores()
+        yield review
+        state = SEEK
+      elif REVIEW_MEDIUM_SEPARATOR in line:
+        # We found a review field.
+        field = REVIEW_FIELDS.get(line)
+        if field is None:
+          print "Unknown field", line
+        content = []
+        field_start = end
+        state = FIELD
+
+  # The dump may end without a separator after the last review.
+  if state == FIELD:
+    end_field(review, field, content, field_start, end)
+  if state >= SCORES_START:
+    review.set_scores(scores)
+    review.fix_missing_scores()
+    yield review
+
+def end_field(review, field, content, start, end):
+  """ Store a review text field that spans bytes [start, end) of the input. """
+  if field is None:
+    return
+  if review.source is None:
+    setattr(review, field, "\n".join(content).decode("utf-8"))
+  else:
+    review.spans[field] = (start, end - start)
+
+def iter_reviews(fname, prefix=REVIEW_PREFIX):
+  """ Generate the reviews of a HotCRP review dump file. """
+  source = ReviewSource(fname)
+  with open(fname, "rb") as review_file:
+    for review in parse_reviews(review_file, prefix, source):
+      yield review
+
+def mapped_lines(data, start, end):
+  """ Generate the lines of data[start:end] without copying the range. """
+  while start < end:
+    newline = data.find("\n", start, end)
+    stop = end if newline == -1 else newline + 1
+    yield data[start:stop]
+    start = stop
+
+def find_review_header(data, pos, prefix=REVIEW_PREFIX):
+  """ Find the next review header line of a dump, searching from pos.
+
+  A header line contains prefix and either starts the dump or follows a big
+  separator line. Returns the offset of the start of the line, or -1.
+  """
+  pos = data.find(prefix, pos)
+  while pos != -1:
+    line_start = data.rfind("\n", 0, pos) + 1
+    prev_start = data.rfind("\n", 0, max(line_start - 1, 0)) + 1
+    if line_start == 0 or REVIEW_BIG_SEPARATOR in data[prev_start:line_start]:
+      return line_start
+    pos = data.find(prefix, pos + 1)
+  return -1
+
+def review_chunks(data, num_chunks, prefix=REVIEW_PREFIX):
+  """ Split a review dump into about num_chunks (start, end) byte ranges.
+
+  Each range after the first starts at the beginning of a review header line,
+  so every review falls entirely within one range.
+  """
+  size = len(data)
+  bounds = [0]
+  for k in range(1, num_chunks):
+    line_start = find_review_header(
+        data, max(size * k // num_chunks, bounds[-1]), prefix)
+    if line_start == -1:
+      break
+    if line_start > bounds[-1]:
+      bounds.append(line_start)
+  bounds.append(size)
+  return zip(bounds[:-1], bounds[1:])
+
+def review_blocks(data, prefix=REVIEW_PREFIX):
+  """ List the (review name, start, end) byte range of each review of a dump.
+
+  A review's range runs from its header line to the next header line.
+  """
+  blocks = []
+  start = find_review_header(data, 0, prefix)
+  while start != -1:
+    line_end = data.find("\n", start)
+    if line_end == -1:
+      line_end = len(data)
+    line = data[start:line_end]
+    name = review_id_re.match(line, line.find(prefix) + len(prefix)).group()
+    end = find_review_header(data, line_end, prefix)
+    blocks.append((unicode(name), start, len(data) if end == -1 else end))
+    start = end
+  return blocks
+
+def index_reviews(review_list, data, prefix=REVIEW_PREFIX):
+  """ Record the byte range and content hash of each review's block.
+
+  update_reviewdb uses them to skip reviews that did not change. Reviews
+  without a block are reported and left unindexed, so they are parsed again
+  on the next update.
+  """
+  blocks = dict((name, (start, end)) for name, start, end in
+                review_blocks(data, prefix))
+  for review in review_list:
+    if review.name not in blocks:
+      print "Review %s has no block in the dump" % review.name
+      continue
+    start, end = blocks[review.name]
+    review.block = (start, end - start)
+    review.digest = hashlib.sha1(data[start:end]).hexdigest()
+
+def parse_review_chunk(task):
+  """ Parse one byte range of a review dump. Used by read_reviewdb. """
+  source, start, end, prefix = task
+  with open(source.fname, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      return list(parse_reviews(mapped_lines(data, start, end), prefix,
+                                source, start))
+    finally:
+      data.close()
+
+def read_reviewdb(fname, prefix=REVIEW_PREFIX, jobs=1):
+  """ Read a review dump into a ReviewDB.
+
+  With more than one job, the memory-mapped dump is split at review
+  boundaries into a few chunks per job, which are parsed in a process pool
+  and put back together in their original order.
+  """
+  if os.path.getsize(fname) == 0:
+    return ReviewDB([])
+  if jobs <= 1:
+    review_list = list(iter_reviews(fname, prefix))
+    with open(fname, "rb") as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        index_reviews(review_list, data, prefix)
+      finally:
+        data.close()
+    return ReviewDB(review_list)
+
+  with open(fname, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      chunks = review_chunks(data, jobs * 4, prefix)
+    finally:
+      data.close()
+  source = ReviewSource(fname)
+  pool = multiprocessing.Pool(jobs)
+  try:
+    results = pool.map(parse_review_chunk,
+                       [(source, start, end, prefix) for start, end in chunks],
+                       chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  review_list = [review for result in results for review in result]
+  # Share one source instead of a copy per chunk.
+  for review in review_list:
+    review.source = source
+  with open(fname, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      index_reviews(review_list, data, prefix)
+    finally:
+      data.close()
+  return ReviewDB(review_list)
+
+def update_reviewdb(reviewdb, fname, prefix=REVIEW_PREFIX, paperdb=None):
+  """ Bring reviewdb up to date with a newer dump of the same reviews.
+
+  Only reviews whose block of the dump changed are parsed again. Unchanged
+  reviews are kept, with their text spans moved to the new dump. Changed
+  reviews are updated in place, so papers keep the same Review objects. If
+  paperdb is given, added reviews are appended to their paper's reviews and
+  removed ones are taken out.
+
+  Returns the names of the added, changed and removed reviews.
+  """
+  source = ReviewSource(fname)
+  old_reviews = dict((review.name, review) for review in
+                     getattr(reviewdb, "reviews", None) or list(reviewdb))
+  added = []
+  changed = []
+  review_list = []
+  with open(fname, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for name, start, end in review_blocks(data, prefix):
+        digest = hashlib.sha1(data[start:end]).hexdigest()
+        review = old_reviews.pop(name, None)
+        if review is not None and getattr(review, "digest", None) == digest:
+          shift = start - review.block[0]
+          review.spans = dict((field, (offset + shift, length))
+                              for field, (offset, length)
+                              in review.spans.iteritems())
         else:
-          print "Review %s is missing reviewer email" % review_id
-      current_review.reviewer = reviewer
-
-      # Get the review scores.
-      line = review_file.readline().strip()
-      while not line or REVIEW_SMALL_SEPARATOR in line:
-        line = review_file.readline().strip()
-
-      scores = {}
-      while line:
-        score_match = re.findall(score_re, line)
-        if len(score_match) == 3:
-          score_type = score_match[0]
-          score_val = int(score_match[1])
-          scores[score_type] = score_val
-        line = review_file.readline().strip()
-
-      current_review.set_scores(scores)
-      current_review.fix_missing_scores()
-
-      # Get the review text.
-      while not REVIEW_BIG_SEPARATOR in line:
-        if not line:
-          line = review_file.readline().strip()
-          continue
-        if REVIEW_MEDIUM_SEPARATOR in line:
-          # We found a review field.
-          review_field_name = line
-          # Read the rest of the field.
-          line = review_file.readline().strip()
-          review_content = []
-          while (not REVIEW_MEDIUM_SEPARATOR in line):
-            review_content.append(line)
-            line = review_file.readline().strip()
-          review_content_str = "\n".join(review_content)
-
-          if review_field_name == REVIEW_SUMMARY:
-            current_review.paper_summary = review_content_str
-          elif review_field_name == REVIEW_STRENGTHS:
-            current_review.strengths = review_content_str
-          elif review_field_name == REVIEW_WEAKNESSES:
-            current_review.weaknesses = review_content_str
-          elif review_field_name == REVIEW_AUTHOR_QUESTIONS:
-            current_review.questions_for_authors = review_content_str
-          elif review_field_name == REVIEW_AUTHOR_COMMENTS:
-            current_review.comments_to_authors = review_content_str
-          elif review_field_name == REVIEW_PC_COMMENTS:
-            current_review.comments_to_PC = review_content_str
-          elif review_field_name == REVIEW_POST_REB_COMMENTS:
-            current_review.post_reb_comments_to_authors = review_content_str
+          new_review = next(parse_reviews(mapped_lines(data, start, end),
+                                          prefix, source, start))
+          new_review.digest = digest
+          if review is None:
+            added.append(name)
+            review = new_review
+            if paperdb is not None:
+              paperdb[review.paper_id].reviews.append(review)
           else:
-            print "Unknown field", review_field_name
-        else:
-          line = review_file.readline().strip()
+            changed.append(name)
+            # Drop any text kept from an older parse.
+            for field in REVIEW_FIELDS.itervalues():
+              review.__dict__.pop(field, None)
+            review.__dict__.update(new_review.__dict__)
+        review.block = (start, end - start)
+        review.source = source
+        review_list.append(review)
+    finally:
+      data.close()
 
-      review_list.append(current_review)
-      current_review = None
+  removed = sorted(old_reviews)
+  if paperdb is not None:
+    for review in old_reviews.itervalues():
+      paperdb[review.paper_id].reviews.remove(review)
+  reviewdb.set_reviews(review_list)
+  return added, changed, removed
 
-  return ReviewDB(review_list)
+def write_synthetic_dump(fname, num_papers, reviews_per_paper=3, seed=0):
+  """ Write a made-up review dump in the HotCRP format, for benchmarks. """
+  rng = random.Random(seed)
+  big = "=" * 75 + "\n"
+  small = "-" * 75 + "\n"
+  with open(fname, "wb") as f:
+    for paper_id in range(1, num_papers + 1):
+      for r in range(reviews_per_paper):
+        name = "%d%s" % (paper_id, chr(ord("A") + r))
+        member = rng.randint(1, 200)
+        f.write(big)
+        f.write("%s%s%s\n" % (" " * 25, REVIEW_PREFIX, name))
+        f.write("%sUpdated 1 Jan 2017 1:00:00am EST\n" % (" " * 17))
+        f.write(small)
+        f.write("      Paper #%d: Paper %d\n" % (paper_id, paper_id))
+        f.write(small)
+        f.write("%sReviewer: Member %d <member%d@example.org>\n" % (
+            " " * 17, member, member))
+        f.write(small + "\n")
+        for category in ["Post rebuttal overall merit", "Overall merit",
+                         "Novelty", "Writing quality", "Reviewer expertise"]:
+          f.write("%28s: %d. Description\n" % (category, rng.randint(1, 5)))
+        f.write("\n")
+        for header in [REVIEW_SUMMARY, REVIEW_STRENGTHS, REVIEW_WEAKNESSES,
+                       REVIEW_AUTHOR_COMMENTS, REVIEW_AUTHOR_QUESTIONS]:
+          f.write("%s%s\n\n" % (" " * 20, header))
+          for i in range(rng.randint(1, 12)):
+            f.write("Lorem ipsum dolor sit amet, consectetur adipiscing elit, "
+                    "sed do eiusmod tempor incididunt ut labore.\n")
+          f.write("\n")
+    f.write(big)
+
+def benchmark(fname, repeat=3, prefix=REVIEW_PREFIX, jobs=1):
+  """ Print how fast a review dump is read, in MB/s (best of repeat). """
+  size = os.path.getsize(fname)
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    num_reviews = len(read_reviewdb(fname, prefix, jobs).reviews)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  print "%s: %d reviews, %.1f MB in %.2f s (%.1f MB/s)" % (
+      fname, num_reviews, size / 1e6, best, size / 1e6 / max(best, 1e-9))
 
 def merge_with_paperdb(reviewdb, paperdb):
   for review in reviewdb:
     paperdb[review.paper_id].reviews.append(review)
+
+if __name__ == "__main__":
+  # Usage: reviews.py [--jobs N] DUMP... to benchmark the parser, or
+  #        reviews.py --synthetic NUM_PAPERS DUMP to write a test dump.
+  import sys
+  if len(sys.argv) < 2 or (sys.argv[1] == "--synthetic" and len(sys.argv) != 4):
+    print "Usage: %s [--jobs N] DUMP..." % sys.argv[0]
+    print "       %s --synthetic NUM_PAPERS DUMP" % sys.argv[0]
+    sys.exit(1)
+  if sys.argv[1] == "--synthetic":
+    write_synthetic_dump(sys.argv[3], int(sys.argv[2]))
+  else:
+    jobs = 1
+    fnames = sys.argv[1:]
+    if fnames[0] == "--jobs":
+      jobs = int(fnames[1])
+      fnames = fnames[2:]
+    for fname in fnames:
+      benchmark(fname, jobs=jobs)
@@ -15,12 +15,15 @@
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv partition-papers --use-existing-paper-partitions --existing-update-csv "update_combined.csv"
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv partition-papers \
 #   --use-existing-paper-partitions --existing-update-csv "update_combined.csv"
+# python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv partition-joint --existing-update-csv "update_combined.csv"
 
 # Misc
 # ----
+# python institutions.py data/institutions.csv
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo-tags.csv data/institutions.csv analyze-topics
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv export-preferences
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv merge-conflicts-assignments
+# python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv assign-reviews --existing-update-csv "update_combined.csv" --preferences preferences.csv
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv pc-chair-coi --existing-update-csv "update_combined.csv"
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv pc-meeting-plots --existing-update-csv "correct/update_all_conflicts_including_orig.csv" --review-file data/isca2017db-reviews.txt --load
 # python main.py data/isca2017db-data.json data/isca2017db-pcinfo.csv data/institutions.csv upload-reviews --existing-update-csv "correct/update_all_conflicts_including_orig.csv" --review-file data/isca2017db-reviews.txt --load
@@ -2,12 +2,15 @@
 #
 # Mostly used for manipulation of spreadsheets and other csvs.
 
-import codecs
 import sys
+import time
+
+import calibration
 import export2hotcrp
 import partitionpapers
 import partitionpc
 import plots
+import reviews
 
 def count_topics():
   topics_by_paper = {}
@@ -25,22 +28,28 @@ def try_pre_process(args, paperdb, pcdb, instdb):
     sys.exit()
 
   if args.mode == "upload-reviews":
-    with codecs.open("isca2017db-reviews-form-filled.txt", encoding="utf-8", mode="w") as f:
-      header = ("==+== ISCA 2017 Paper Review Forms\n"
-               "==-== DO NOT CHANGE LINES THAT START WITH \"==+==\" UNLESS DIRECTED!\n"
-               "==-== For further guidance, or to upload this file when you are done, go to:\n"
-               "==-== https://isca2017.eecs.harvard.edu/offline\n")
-      print >>f, header
-      for paper in paperdb:
-        for review in paper.reviews:
-          review.print_offline_form(f)
+    header = (u"==+== ISCA 2017 Paper Review Forms\n"
+              u"==-== DO NOT CHANGE LINES THAT START WITH \"==+==\" UNLESS DIRECTED!\n"
+              u"==-== For further guidance, or to upload this file when you are done, go to:\n"
+              u"==-== https://isca2017.eecs.harvard.edu/offline\n\n")
+    max_bytes = None
+    if args.upload_size_limit:
+      max_bytes = int(args.upload_size_limit * 1024 * 1024)
+    fnames = reviews.write_offline_forms(
+        "isca2017db-reviews-form-filled.txt",
+        (review for paper in paperdb for review in paper.reviews),
+        header, max_bytes)
+    print "Wrote", ", ".join(fnames)
     sys.exit()
 
   if args.mode == "export-preferences":
+    name_column, first_paper_column = [
+        int(c) for c in args.preference_columns.split(",")]
     export2hotcrp.export_review_preferences(
         "saturday_scored_papers.csv",
         "saturday-preferences-update.csv",
-        pcdb)
+        pcdb, args.chunk_rows, name_column, first_paper_column,
+        args.preference_exclude or export2hotcrp.PREFERENCE_EXCLUDE)
     sys.exit()
 
   if args.mode == "export-pc-partition-tags":
@@ -49,7 +58,7 @@ def try_pre_process(args, paperdb, pcdb, instdb):
     saturday_pc = partitionpc.read_partition_file(
         "pcpartitions/saturday_group.txt", pcdb)
     export2hotcrp.export_pc_partition_tags(
-        "pc-tags-update.csv", friday_pc, saturday_pc)
+        "pc-tags-update.csv", friday_pc, saturday_pc, args.chunk_rows)
     sys.exit()
 
   if args.mode == "merge-conflicts-assignments":
@@ -77,7 +86,7 @@ def try_pre_process(args, paperdb, pcdb, instdb):
     #     saturday_papers, saturday_pc, "_saturday")
     sys.exit()
 
-def try_post_process(args, paperdb, pcdb, instdb):
+def try_post_process(args, paperdb, pcdb, instdb, reviewdb=None):
   if args.mode == "pc-chair-coi":
     # Prepare data for person to take over David's conflicts.
     friday_papers = partitionpapers.import_paper_partition(
@@ -91,5 +100,20 @@ def try_post_process(args, paperdb, pcdb, instdb):
     partitionpc.print_topic_pc_member_spreadsheet(pcdb, "pc_topics.csv")
     sys.exit()
 
+  if args.mode == "calibrate-scores":
+    if reviewdb is None or not hasattr(reviewdb, "score_table"):
+      reviewdb = reviews.ReviewDB(
+          [review for paper in paperdb for review in paper.reviews])
+    start = time.time()
+    ranking, bias = calibration.rank_papers(reviewdb, args.calibration)
+    print "Calibrated %d reviews in %.3f s" % (
+        len(reviewdb.reviews), time.time() - start)
+    calibration.export_ranking("calibrated_ranking.csv", ranking)
+    calibration.export_reviewer_biases("reviewer_biases.csv", reviewdb, bias)
+    print "Rank Paper Calibrated Mean"
+    for rank, (paper_id, merit, mean, count) in enumerate(ranking[:20]):
+      print "%4d %5d %10.2f %4.2f" % (rank + 1, paper_id, merit, mean)
+    sys.exit()
+
   if args.mode == "pc-meeting-plots":
-    plots.plot_pc_meeting(paperdb, pcdb, instdb)
+    plots.plot_pc_meeting(paperdb, pcdb, instdb, reviewdb, args.jobs)
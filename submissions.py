@@ -34,13 +34,21 @@ class Paper(base.BaseObj):
     self.process_collaborators()
     self.process_topics()
 
-  def get_average_score(self, post_or_pre_rebuttal="post"):
+  def get_average_score(self, post_or_pre_rebuttal="post", reviewdb=None):
+    """ Mean overall merit of the reviews; missing scores (0) count.
+
+    If reviewdb has a score table, the mean is read from it.
+    """
+    if post_or_pre_rebuttal == "post":
+      category = "Post rebuttal overall merit"
+    else:
+      category = "Overall merit"
+    if reviewdb is not None and hasattr(reviewdb, "score_table"):
+      return reviewdb.paper_mean(self.id, category)
+
     total_score = 0
     for review in self.reviews:
-      if post_or_pre_rebuttal == "post":
-        total_score += review.scores["Post rebuttal overall merit"]
-      else:
-        total_score += review.scores["Overall merit"]
+      total_score += review.scores[category]
 
     return total_score/float(len(self.reviews))
 